@@ -0,0 +1,179 @@
+import base64
+import os
+import time
+from functools import lru_cache
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# AES-GCM values look like "RENC_g<version>:<urlsafe base64 of nonce + ciphertext + tag>".
+# Legacy Fernet values ("RENC_v<version>:<token>" in redis, bare tokens in mongo) are written by authorization.auth.encrypt_token.
+GCM_PREFIX = "RENC_g"
+LEGACY_PREFIX = "RENC_v"
+NONCE_BYTES = 12
+
+# AESGCM_KEYS="1:<base64 key>,2:<base64 key>", keys of 16, 24 or 32 bytes. New values use AESGCM_ACTIVE_VERSION (default: the highest).
+# Without keys every value is written with the legacy Fernet scheme.
+AESGCM_KEYS = os.environ.get("AESGCM_KEYS", "")
+AESGCM_ACTIVE_VERSION = os.environ.get("AESGCM_ACTIVE_VERSION")
+# Google tokens are also read by the OAuth flow in authorization.auth; keep them on Fernet until it reads through this module
+AESGCM_FOR_TOKENS = os.environ.get("AESGCM_FOR_TOKENS", "false").lower() == "true"
+# FERNET_KEYS="1:<fernet key>,2:<fernet key>", the keys authorization.auth encrypts with, so legacy values of each version
+# are read here directly. Values of a version without a key here are decrypted by authorization.auth, see legacy_auth.
+FERNET_KEYS = os.environ.get("FERNET_KEYS", "")
+
+def parse_keys(spec):
+    keys = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        version, _, key = entry.partition(":")
+        keys[int(version)] = key
+    return keys
+
+def load_ciphers(spec):
+    """
+    Cipher object of each key version in spec, built once per process.
+    """
+    return {version: AESGCM(base64.urlsafe_b64decode(key)) for version, key in parse_keys(spec).items()}
+
+ciphers = load_ciphers(AESGCM_KEYS)
+fernets = {version: Fernet(key) for version, key in parse_keys(FERNET_KEYS).items()}
+# mongo tokens carry no version, they are tried with the newest key first
+token_fernet = MultiFernet([fernets[version] for version in sorted(fernets, reverse=True)]) if fernets else None
+active_version = int(AESGCM_ACTIVE_VERSION) if AESGCM_ACTIVE_VERSION else max(ciphers, default=None)
+if active_version is not None and active_version not in ciphers:
+    raise ValueError(f"AESGCM_ACTIVE_VERSION {active_version} has no key in AESGCM_KEYS")
+
+def is_encrypted(value):
+    return isinstance(value, str) and (value.startswith(GCM_PREFIX) or value.startswith(LEGACY_PREFIX))
+
+def key_version(value):
+    """
+    Key version of an AES-GCM value, None for legacy values.
+    """
+    if not value.startswith(GCM_PREFIX):
+        return None
+    return int(value[len(GCM_PREFIX):value.index(":")])
+
+def uses_aesgcm(is_redis):
+    return active_version is not None and (is_redis or AESGCM_FOR_TOKENS)
+
+def gcm_header(version):
+    return f"{GCM_PREFIX}{version}:"
+
+def encrypt_with(cipher, header, value, nonce):
+    sealed = cipher.encrypt(nonce, value.encode("utf-8"), header.encode("ascii"))
+    return header + base64.urlsafe_b64encode(nonce + sealed).decode("ascii")
+
+def decrypt_gcm(value):
+    header, _, body = value.partition(":")
+    cipher = ciphers.get(int(header[len(GCM_PREFIX):]))
+    if cipher is None:
+        raise ValueError(f"No AES-GCM key for {header}")
+    data = base64.urlsafe_b64decode(body)
+    return cipher.decrypt(data[:NONCE_BYTES], data[NONCE_BYTES:], f"{header}:".encode("ascii")).decode("utf-8")
+
+@lru_cache(maxsize=16)
+def cached_fernet(key):
+    """
+    Fernet cipher of a key, built once per process.
+    """
+    return Fernet(key)
+
+def legacy_auth():
+    """
+    authorization.auth, with the Fernet it builds per call swapped for cached_fernet so its key's cipher is reused.
+    """
+    from authorization import auth
+    if getattr(auth, "Fernet", None) is Fernet:
+        auth.Fernet = cached_fernet
+    return auth
+
+def decrypt_legacy(value, is_redis):
+    fernet, token = token_fernet, value
+    if is_redis:
+        version, _, token = value[len(LEGACY_PREFIX):].partition(":")
+        fernet = fernets.get(int(version)) if version.isdigit() else None
+    if fernet is not None:
+        try:
+            return fernet.decrypt(token.encode("ascii")).decode("utf-8")
+        except InvalidToken:
+            pass # not one of the configured keys, authorization.auth may still know it
+
+    return legacy_auth().decrypt_token(value, is_redis)
+
+def encrypt(value, is_redis=False, version=None):
+    """
+    Encrypt a text value, with AES-GCM under the active key version (or the given one) when keys are configured.
+    is_redis selects the redis variant of the legacy scheme, as in authorization.auth.encrypt_token.
+    """
+    return encrypt_many([value], is_redis, version)[0]
+
+def decrypt(value, is_redis=False):
+    """
+    Decrypt a value written by encrypt or by authorization.auth.encrypt_token.
+    """
+    if value.startswith(GCM_PREFIX):
+        return decrypt_gcm(value)
+    return decrypt_legacy(value, is_redis)
+
+def encrypt_many(values, is_redis=False, version=None):
+    """
+    Encrypt several text values with one cipher lookup and one call for randomness.
+    """
+    if not uses_aesgcm(is_redis):
+        auth = legacy_auth()
+        return [auth.encrypt_token(value, is_redis) for value in values]
+
+    version = active_version if version is None else version
+
+    cipher, header = ciphers[version], gcm_header(version)
+    nonces = os.urandom(NONCE_BYTES * len(values))
+    return [encrypt_with(cipher, header, value, nonces[i * NONCE_BYTES:(i + 1) * NONCE_BYTES]) for i, value in enumerate(values)]
+
+def decrypt_many(values, is_redis=False):
+    """
+    Decrypt several values, in order. Raises on the first value that cannot be decrypted.
+    """
+    return [decrypt(value, is_redis) for value in values]
+
+#### Micro-benchmark ####
+
+def measure(label, func, payloads, seconds):
+    done, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        func(payloads)
+        done += len(payloads)
+    rate = done / (time.perf_counter() - started)
+    print(f"{label:<34}{rate:>14,.0f} ops/s", flush=True)
+
+def run_benchmark(payload_bytes=400, batch=100, seconds=1.0):
+    """
+    Print encrypt and decrypt throughput of each scheme on payloads the size of a packed chat entry, with throwaway keys.
+    """
+    payloads = [os.urandom(payload_bytes // 2).hex() for _ in range(batch)]
+
+    fernet = Fernet(Fernet.generate_key())
+    fernet_values = [fernet.encrypt(value.encode("utf-8")).decode("ascii") for value in payloads]
+    measure("fernet encrypt", lambda values: [fernet.encrypt(value.encode("utf-8")) for value in values], payloads, seconds)
+    measure("fernet decrypt", lambda values: [fernet.decrypt(value.encode("ascii")) for value in values], fernet_values, seconds)
+
+    bench_version = max(ciphers, default=0) + 1  # never shadows a configured key
+    cipher, header = AESGCM(AESGCM.generate_key(bit_length=256)), gcm_header(bench_version)
+    def gcm_encrypt_many(values):
+        nonces = os.urandom(NONCE_BYTES * len(values))
+        return [encrypt_with(cipher, header, value, nonces[i * NONCE_BYTES:(i + 1) * NONCE_BYTES]) for i, value in enumerate(values)]
+    gcm_values = gcm_encrypt_many(payloads)
+    ciphers[bench_version] = cipher
+    try:
+        measure("aes-gcm encrypt (encrypt_many)", gcm_encrypt_many, payloads, seconds)
+        measure("aes-gcm decrypt (decrypt_many)", lambda values: [decrypt_gcm(value) for value in values], gcm_values, seconds)
+    finally:
+        del ciphers[bench_version]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Encryption throughput of each scheme, in operations per second.")
+    parser.add_argument("--payload-bytes", type=int, default=400)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=1.0, help="time spent on each measurement")
+    args = parser.parse_args()
+    run_benchmark(args.payload_bytes, args.batch, args.seconds)
@@ -1,20 +1,34 @@
+import os
+from twilio.twiml.messaging_response import MessagingResponse
 from authorization.creds import *
 from variables.keywords import *
 from llm.chat_completions import invoke_model
 from llm.assistant import invoke_assistant, check_thread_status_and_purge
 from helperFiles.helpers import send_error_whatsapp_message, send_whatsapp_message, trim_reply
-from services.database import deduct_chat_balance, add_interaction
-from helperFiles.redis_helper import add_and_delete_user_chat_redis
+from services.database import deduct_chat_balance, record_interaction
+from helperFiles.redis_helper import add_and_delete_user_chat_redis, claim_message_sid
 from helperFiles.buffer import handle_message
-from helperFiles.queue_helper import safe_enqueue
+from helperFiles.queue_helper import safe_enqueue, enqueue_in_lane
+from helperFiles.quota_helper import admit_chat
+from helperFiles.backpressure import should_shed, pipeline_started, pipeline_finished
+from variables.text import daily_limit_reached, system_busy
 from helperFiles.sentry_helper import set_sentry_context
 
+# When enabled the webhook only validates and queues the message; the whole LLM pipeline runs on the RQ worker
+FAST_ACK_MODE = os.environ.get("FAST_ACK_MODE", "false").lower() == "true"
+
 def start_process(resp, user, user_id, record_user_id, incoming_msg, is_test, image_data_url, voice_data_filename, twilio_number, is_assistant=False, prompt_type='main'):
     """
     Start the LLM processing for the incoming message.
     """
     print(f"########### Starting process: {incoming_msg}, {user_id}, image: {bool(image_data_url)}, voice: {bool(voice_data_filename)}", flush=True)
+    pipeline_started()
     try:
+        admitted, _ = admit_chat(user_id, user.get('type', 'regular') if user else 'regular')
+        if not admitted:
+            send_whatsapp_message(record_user_id, daily_limit_reached, twilio_number)
+            return
+
         if is_assistant:
             result = invoke_assistant(resp, user_id, incoming_msg, is_test, image_data_url, voice_data_filename, twilio_number)
         else:
@@ -43,21 +57,45 @@ def start_process(resp, user, user_id, record_user_id, incoming_msg, is_test, im
 
         print(f"########### End process {user_id}. Response: {reply_text}", flush=True)
 
-        # sending queue job to add analytics
-        safe_enqueue(add_interaction, incoming_msg, reply_text, user_id, input_type)
+        # buffering analytics, written to mongo in batches
+        record_interaction(incoming_msg, reply_text, user_id, input_type)
 
         if not is_assistant:
             add_and_delete_user_chat_redis(user_id, incoming_msg, reply_text)
         else:
             check_thread_status_and_purge(user_id, 24, 10)
 
-        safe_enqueue(deduct_chat_balance, user.get('user_details', {}) if user else {}, user_id)
+        safe_enqueue(deduct_chat_balance, user_id)
 
         print(f"########### End process {user_id}. Response: {reply_text}", flush=True)
     except Exception as e:
         print(f"########### ERROR in start_process: {e}", flush=True)
         set_sentry_context(user_id, incoming_msg, None, f"Error in start_process function: Processing failed", e)
         raise
+    finally:
+        pipeline_finished()
+
+def run_process_job(user_id, record_user_id, incoming_msg, is_test, image_data_url, voice_data_filename, twilio_number, is_assistant=False, prompt_type='main', user_type='regular'):
+    """
+    RQ job running the full start_process chain on a worker.
+    The webhook has already returned its TwiML, so the job works with a fresh response object.
+    Only the user type travels with the job.
+    """
+    resp = MessagingResponse()
+    return start_process(resp, {"type": user_type}, user_id, record_user_id, incoming_msg, is_test, image_data_url, voice_data_filename, twilio_number, is_assistant, prompt_type)
+
+def enqueue_process(resp, user, user_id, record_user_id, incoming_msg, is_test, image_data_url, voice_data_filename, twilio_number, is_assistant=False, prompt_type='main'):
+    """
+    Drop-in replacement for start_process that hands the pipeline to the RQ queue instead of running it on the calling thread.
+    Jobs go through the user's lane so two messages of one user never race on their chat memory and draft.
+    """
+    print(f"########### Queueing process for {user_id}, image: {bool(image_data_url)}", flush=True)
+    return enqueue_in_lane(
+        user_id,
+        run_process_job,
+        user_id, record_user_id, incoming_msg, is_test, image_data_url, voice_data_filename, twilio_number, is_assistant, prompt_type,
+        user_type=user.get('type', 'regular') if user else 'regular'
+    )
 
 def start_or_buffer_message(
     resp,
@@ -71,31 +109,41 @@ def start_or_buffer_message(
     media_url=None,
     image_data_url=None,
     voice_data_filename=None,
-    prompt_type='main'
+    prompt_type='main',
+    message_sid=None
 ):
     """
     Handle the incoming message, either processing it immediately or buffering it.
+    Pass the Twilio MessageSid so webhook retries of the same message are dropped.
     """
     if not incoming_msg and not image_data_url and not voice_data_filename:
         print(f"⚠️ Skipping empty message for {user_id}")
         return
 
-    if media_url and incoming_msg:
-        # process immediately
-        start_process(resp, user, user_id, record_user_id, incoming_msg, is_test, image_data_url, voice_data_filename, twilio_number, is_assistant, prompt_type)
-    else:
-        # use buffer for delayed message
-        handle_message(
-            resp,
-            user,
-            user_id,
-            record_user_id,
-            incoming_msg,
-            is_test,
-            twilio_number,
-            is_assistant,
-            start_process,
-            image_data_url,
-            voice_data_filename,
-            prompt_type
-        )
+    if not claim_message_sid(message_sid):
+        print(f"⚠️ Skipping duplicate delivery of message {message_sid} for {user_id}", flush=True)
+        return
+
+    if should_shed(user, is_test):
+        # answer in the webhook reply itself, nothing is queued for this message
+        resp.message(system_busy)
+        return
+
+    process = enqueue_process if FAST_ACK_MODE else start_process
+
+    # media with a caption is processed immediately, anything else waits in the buffer for the rest of the burst
+    handle_message(
+        resp,
+        user,
+        user_id,
+        record_user_id,
+        incoming_msg,
+        is_test,
+        twilio_number,
+        is_assistant,
+        process,
+        image_data_url,
+        voice_data_filename,
+        prompt_type,
+        flush_now=bool(media_url and incoming_msg)
+    )
@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from helperFiles.redis_helper import r
+from helperFiles.queue_helper import queues
+from helperFiles.flush_scheduler import FLUSH_MAX_WORKERS, flush_backlog
+from helperFiles.sentry_helper import set_sentry_context
+
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 2))             # gunicorn --threads, see the Procfile
+SHED_QUEUE_DEPTH = int(os.environ.get("SHED_QUEUE_DEPTH", 50))  # waiting interactive jobs that count as full load
+# pipelines running or waiting to run in this process that count as full load, by default as many as can run at once:
+# one per flush thread plus one per request thread (messages flushed right away run on the request thread)
+SHED_INFLIGHT = int(os.environ.get("SHED_INFLIGHT", FLUSH_MAX_WORKERS + WEB_THREADS))
+
+# load level at which each tier starts getting the busy reply, lowest tier first
+SHED_THRESHOLDS = {
+    "test": float(os.environ.get("SHED_TEST_AT", 0.7)),            # regular users on the shared test calendar
+    "regular": float(os.environ.get("SHED_REGULAR_AT", 0.9)),      # regular users on their own calendar
+    "unlimited": float(os.environ.get("SHED_UNLIMITED_AT", 2.0)),
+}
+QUEUE_DEPTH_CACHE_SECONDS = 1
+BACKPRESSURE_METRICS_KEY = "metrics:backpressure"
+
+inflight_pipelines = 0
+inflight_lock = threading.Lock()
+queue_depth_cache = {"depth": 0, "checked_at": 0.0}
+
+def pipeline_started():
+    global inflight_pipelines
+    with inflight_lock:
+        inflight_pipelines += 1
+
+def pipeline_finished():
+    global inflight_pipelines
+    with inflight_lock:
+        inflight_pipelines = max(inflight_pipelines - 1, 0)
+
+def get_queue_depth():
+    # read at most once per second per process, webhooks arrive far more often under load
+    now = time.monotonic()
+    if now - queue_depth_cache["checked_at"] >= QUEUE_DEPTH_CACHE_SECONDS:
+        queue_depth_cache["depth"] = queues["interactive"].count
+        queue_depth_cache["checked_at"] = now
+    return queue_depth_cache["depth"]
+
+def current_load():
+    """
+    Load as a fraction of capacity, from the interactive queue backlog and the pipelines running or waiting for a flush thread in this process.
+    """
+    return max(get_queue_depth() / SHED_QUEUE_DEPTH, (inflight_pipelines + flush_backlog()) / SHED_INFLIGHT)
+
+def get_user_tier(user, is_test):
+    user_type = user.get('type', 'regular') if user else 'regular'
+    if user_type == 'unlimited':
+        return 'unlimited'
+    return 'test' if is_test else 'regular'
+
+def should_shed(user, is_test):
+    """
+    Decide whether to turn this message away with a busy reply, recording shed and admit counts per tier.
+    """
+    tier = get_user_tier(user, is_test)
+    try:
+        load = current_load()
+    except Exception as e:
+        print(f"❌ Error measuring load, admitting message: {e}", flush=True)
+        set_sentry_context(None, None, None, f"Error in should_shed function: Failed to measure load", e)
+        return False
+
+    shed = load >= SHED_THRESHOLDS[tier]
+    try:
+        r.hincrby(BACKPRESSURE_METRICS_KEY, f"{'shed' if shed else 'admit'}:{tier}", 1)
+    except Exception as e:
+        print(f"❌ Error recording backpressure metrics: {e}", flush=True)
+
+    if shed:
+        print(f"########### Shedding {tier} message at load {load:.2f}", flush=True)
+    return shed
+
+def get_backpressure_stats():
+    try:
+        counts = {field: int(value) for field, value in r.hgetall(BACKPRESSURE_METRICS_KEY).items()}
+    except Exception as e:
+        print(f"❌ Error retrieving backpressure metrics: {e}", flush=True)
+        counts = {}
+    return {"load": current_load(), "inflight_pipelines": inflight_pipelines, "flush_backlog": flush_backlog(), "counts": counts}
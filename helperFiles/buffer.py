@@ -1,12 +1,210 @@
 from datetime import datetime, timezone as tzn
 import threading
+import os
 from collections import defaultdict
 
-message_buffer = defaultdict(list)  # user_id -> list of messages
-timers = {}          # user_id -> Timer
+message_buffer = defaultdict(list)  # user_id -> list of messages (local fallback when redis is unavailable), bounded by the BUFFER_MAX_* caps
+buffer_lock = threading.Lock()      # guards message_buffer, flushes run on the scheduler's thread pool
+
+BUFFER_BACKEND = os.environ.get("BUFFER_BACKEND", "redis")  # "redis" (shared across gunicorn workers) or "memory"
+BUFFER_DELAY_SECONDS = 2
+BUFFER_KEY_TTL_MS = 10 * 60 * 1000  # abandoned buffers are dropped after 10 minutes
+LOCAL_LEASE = "local"  # stands in for the pipeline lease when redis cannot be reached
+
+# Per-user caps. Reaching the message or byte cap flushes the burst right away, a buffer that is still full
+# (its pipeline is busy) turns further messages away until it has been processed.
+BUFFER_MAX_MESSAGES = int(os.environ.get("BUFFER_MAX_MESSAGES", 20))
+BUFFER_MAX_BYTES = int(os.environ.get("BUFFER_MAX_BYTES", 20 * 1024 * 1024))  # text plus the media held for the buffer in the media store
+BUFFER_MAX_IMAGES = int(os.environ.get("BUFFER_MAX_IMAGES", 3))
+BUFFER_SPILL_POLICY = os.environ.get("BUFFER_SPILL_POLICY", "flush_early")  # on too many images: "flush_early" or "drop_oldest_media" (with a notice to the user)
+BUFFER_METRICS_KEY = "metrics:buffer"
 
 from helperFiles.helpers import send_error_whatsapp_message
 from helperFiles.sentry_helper import set_sentry_context
+from helperFiles.redis_helper import r, user_key, encode_secure, decode_secure, acquire_pipeline_lease, release_pipeline_lease, is_pipeline_running, mark_pipeline_pending, pop_pipeline_pending
+from helperFiles.flush_scheduler import schedule_flush
+from helperFiles.media_store import media_size
+from variables.text import buffer_full, buffer_media_dropped
+
+# Append a message to the user's buffer and push the flush deadline forward, using redis server time
+# so every gunicorn worker agrees on when the burst is over. A full buffer refuses the message.
+# KEYS: buffer list, deadline, size hash; ARGV: message, delay ms, ttl ms, message bytes, has image, max messages, max bytes.
+# Returns {accepted, messages, bytes, images}.
+APPEND_MESSAGE_SCRIPT = r.register_script("""
+local size = redis.call('LLEN', KEYS[1])
+local bytes = tonumber(redis.call('HGET', KEYS[3], 'bytes') or '0')
+if size >= tonumber(ARGV[6]) or (size > 0 and bytes >= tonumber(ARGV[7])) then
+    return {0, size, bytes, tonumber(redis.call('HGET', KEYS[3], 'images') or '0')}
+end
+local t = redis.call('TIME')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('RPUSH', KEYS[1], ARGV[1])
+bytes = redis.call('HINCRBY', KEYS[3], 'bytes', ARGV[4])
+local images = redis.call('HINCRBY', KEYS[3], 'images', ARGV[5])
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+redis.call('PEXPIRE', KEYS[3], ARGV[3])
+redis.call('SET', KEYS[2], now_ms + tonumber(ARGV[2]), 'PX', ARGV[3])
+return {1, size + 1, bytes, images}
+""")
+
+# Claim the whole buffer once its deadline has passed. Only one flusher can get the messages,
+# every other caller receives nil.
+CLAIM_MESSAGES_SCRIPT = r.register_script("""
+local t = redis.call('TIME')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local deadline = tonumber(redis.call('GET', KEYS[2]) or '0')
+if ARGV[1] ~= 'force' and deadline > now_ms then
+    return false
+end
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+return items
+""")
+
+# Replace a buffered message with its copy without image, unless it was claimed or changed in the meantime.
+# KEYS: buffer list, size hash; ARGV: index, current item, new item, bytes freed.
+DROP_MEDIA_SCRIPT = r.register_script("""
+if redis.call('LINDEX', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('LSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('HINCRBY', KEYS[2], 'bytes', -tonumber(ARGV[4]))
+redis.call('HINCRBY', KEYS[2], 'images', -1)
+return 1
+""")
+
+def buffer_keys(user_id):
+    return [user_key("buffer", user_id), user_key("buffer_deadline", user_id), user_key("buffer_size", user_id)]
+
+def media_bytes(message, field):
+    # sizes are recorded by handle_message when the message is buffered
+    if not message[field]:
+        return 0
+    return message[f"{field.split('_')[0]}_bytes"]
+
+def message_size(message):
+    return len((message["incoming_msg"] or "").encode("utf-8")) + media_bytes(message, "image_data_url") + media_bytes(message, "voice_data_filename")
+
+def buffer_size(messages):
+    return {
+        "messages": len(messages),
+        "bytes": sum(message_size(m) for m in messages),
+        "images": sum(1 for m in messages if m["image_data_url"]),
+    }
+
+def is_over_caps(size):
+    return size["messages"] >= BUFFER_MAX_MESSAGES or size["bytes"] >= BUFFER_MAX_BYTES
+
+def push_message_redis(user_id, message):
+    """
+    Add a message to the shared redis buffer of a user and extend the flush deadline.
+    Returns whether the message was accepted, and the size of the buffer.
+    """
+    key, deadline_key, size_key = buffer_keys(user_id)
+    entry = dict(message, timestamp=message["timestamp"].isoformat())
+    accepted, messages, size_bytes, images = APPEND_MESSAGE_SCRIPT(
+        keys=[key, deadline_key, size_key],
+        args=[
+            encode_secure(key, entry), int(BUFFER_DELAY_SECONDS * 1000), BUFFER_KEY_TTL_MS,
+            message_size(message), 1 if message["image_data_url"] else 0, BUFFER_MAX_MESSAGES, BUFFER_MAX_BYTES
+        ]
+    )
+    return bool(accepted), {"messages": messages, "bytes": size_bytes, "images": images}
+
+def push_message_local(user_id, message):
+    with buffer_lock:
+        messages = message_buffer[user_id]
+        size = buffer_size(messages)
+        if messages and (size["messages"] >= BUFFER_MAX_MESSAGES or size["bytes"] >= BUFFER_MAX_BYTES):
+            return False, size
+        messages.append(message)
+        return True, buffer_size(messages)
+
+def claim_messages_redis(user_id, force=False):
+    """
+    Atomically take all buffered messages of a user from redis.
+    Returns None when the burst is still open (a newer message moved the deadline), so only the last flusher processes it.
+    """
+    items = CLAIM_MESSAGES_SCRIPT(keys=buffer_keys(user_id), args=["force" if force else ""])
+    if items is None:
+        return None
+
+    messages = []
+    for item in items:
+        message = decode_secure(item)
+        if isinstance(message, dict):
+            message["timestamp"] = datetime.fromisoformat(message["timestamp"])
+            messages.append(message)
+    return messages
+
+def drop_oldest_image_redis(user_id):
+    key, _, size_key = buffer_keys(user_id)
+    for index, item in enumerate(r.lrange(key, 0, -1)):
+        message = decode_secure(item)
+        if isinstance(message, dict) and message.get("image_data_url"):
+            freed = media_bytes(message, "image_data_url")
+            message.update(image_data_url=None, image_bytes=0)
+            if DROP_MEDIA_SCRIPT(keys=[key, size_key], args=[index, item, encode_secure(key, message), freed]):
+                return freed
+            return None
+    return None
+
+def drop_oldest_image(user_id):
+    """
+    Remove the image of the oldest buffered message that has one. Returns the bytes freed, or None when nothing was dropped.
+    """
+    with buffer_lock:
+        for message in message_buffer.get(user_id, []):
+            if message["image_data_url"]:
+                freed = media_bytes(message, "image_data_url")
+                message.update(image_data_url=None, image_bytes=0)
+                return freed
+
+    if BUFFER_BACKEND != "redis":
+        return None
+    try:
+        return drop_oldest_image_redis(user_id)
+    except Exception as e:
+        print(f"[BUFFER] Error dropping buffered image for {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in drop_oldest_image function: Failed to drop buffered image", e)
+        return None
+
+def record_buffer_event(event):
+    try:
+        r.hincrby(BUFFER_METRICS_KEY, event, 1)
+    except Exception as e:
+        print(f"[BUFFER] Error recording buffer metrics: {e}", flush=True)
+
+def get_buffer_stats(user_id=None):
+    """
+    Buffer size of one user (local and redis), or the local buffer totals of this process with the spill counts.
+    """
+    if user_id is not None:
+        with buffer_lock:
+            stats = {"local": buffer_size(message_buffer.get(user_id, []))}
+        try:
+            key, _, size_key = buffer_keys(user_id)
+            size = r.hgetall(size_key)
+            stats["redis"] = {"messages": r.llen(key), "bytes": int(size.get("bytes", 0)), "images": int(size.get("images", 0))}
+        except Exception as e:
+            print(f"[BUFFER] Error reading redis buffer size for {user_id}: {e}", flush=True)
+        return stats
+
+    with buffer_lock:
+        sizes = {buffered_user: buffer_size(messages) for buffered_user, messages in message_buffer.items() if messages}
+    try:
+        counts = {field: int(value) for field, value in r.hgetall(BUFFER_METRICS_KEY).items()}
+    except Exception as e:
+        print(f"[BUFFER] Error retrieving buffer metrics: {e}", flush=True)
+        counts = {}
+    return {
+        "users": len(sizes),
+        "messages": sum(size["messages"] for size in sizes.values()),
+        "bytes": sum(size["bytes"] for size in sizes.values()),
+        "images": sum(size["images"] for size in sizes.values()),
+        "largest_user_bytes": max((size["bytes"] for size in sizes.values()), default=0),
+        "counts": counts,
+    }
 
 def handle_message(
     resp,
@@ -20,23 +218,62 @@ def handle_message(
     start_process,
     image_data_url=None,
     voice_data_filename=None,
-    prompt_type='main'
+    prompt_type='main',
+    flush_now=False
 ):
     try:
         now = datetime.now(tzn.utc)
-        message = {"incoming_msg": incoming_msg, "image_data_url": image_data_url, "voice_data_filename": voice_data_filename, "timestamp": now}
+        message = {
+            "incoming_msg": incoming_msg, "image_data_url": image_data_url, "voice_data_filename": voice_data_filename, "timestamp": now,
+            "image_bytes": media_size(image_data_url), "voice_bytes": media_size(voice_data_filename),
+        }
+
+        if BUFFER_BACKEND == "redis":
+            try:
+                accepted, size = push_message_redis(user_id, message)
+            except Exception as e:
+                print(f"[BUFFER] Redis buffer unavailable, buffering locally: {e}", flush=True)
+                set_sentry_context(user_id, None, None, f"Error in handle_message function: Redis buffer unavailable, buffering locally", e)
+                accepted, size = push_message_local(user_id, message)
+        else:
+            accepted, size = push_message_local(user_id, message)
+
+        if not accepted:
+            # the burst already hit its caps and is waiting for the user's running pipeline
+            print(f"[BUFFER] Buffer full for {user_id} ({size['messages']} messages, {size['bytes']} bytes), turning message away", flush=True)
+            record_buffer_event("rejected")
+            resp.message(buffer_full)
+            return
+
+        if size["images"] > BUFFER_MAX_IMAGES and BUFFER_SPILL_POLICY == "drop_oldest_media":
+            dropped = 0
+            while size["images"] > BUFFER_MAX_IMAGES:
+                freed = drop_oldest_image(user_id)
+                if freed is None:
+                    break
+                size = dict(size, images=size["images"] - 1, bytes=size["bytes"] - freed)
+                dropped += 1
+            if dropped:
+                print(f"[BUFFER] Dropped {dropped} older images of {user_id}", flush=True)
+                record_buffer_event("media_dropped")
+                resp.message(buffer_media_dropped)
 
-        message_buffer[user_id].append(message)
+        if flush_now:
+            # still goes through the buffer so it is merged with a burst in progress and respects the user's pipeline lease
+            print(f"[BUFFER] Flushing message for {user_id} immediately", flush=True)
+            return process_buffered_messages(resp, user, user_id, record_user_id, is_test, twilio_number, is_assistant, start_process, prompt_type, force=True)
 
-        # Cancel previous timer if exists
-        if user_id in timers:
-            timers[user_id].cancel()
+        spill = is_over_caps(size) or size["images"] > BUFFER_MAX_IMAGES
+        if spill:
+            print(f"[BUFFER] Buffer of {user_id} reached its caps ({size['messages']} messages, {size['bytes']} bytes, {size['images']} images), flushing early", flush=True)
+            record_buffer_event("flush_early")
 
-        # Start a new 2-second timer with all args
-        timers[user_id] = threading.Timer(
-            2,
+        # Replaces any pending flush for this user, so the 2-second window restarts on every message
+        schedule_flush(
+            user_id,
+            0 if spill else BUFFER_DELAY_SECONDS,
             process_buffered_messages,
-            args=[
+            [
                 resp,
                 user,
                 user_id,
@@ -45,10 +282,10 @@ def handle_message(
                 twilio_number,
                 is_assistant,
                 start_process,
-                prompt_type
+                prompt_type,
+                spill
             ]
         )
-        timers[user_id].start()
         print(f"[BUFFER] Queued message for {user_id} at {now.isoformat()}: text={bool(incoming_msg)}, image={bool(image_data_url)}, voice={bool(voice_data_filename)}")
     except Exception as e:
         print(f"[BUFFER] Error in handle_message: {e}", flush=True)
@@ -63,25 +300,90 @@ def process_buffered_messages(
     twilio_number,
     is_assistant,
     start_process,
-    prompt_type='main'
+    prompt_type='main',
+    force=False
 ):
+    """
+    Run start_process on the user's buffered messages, at most one pipeline per user at a time.
+    Messages arriving while a pipeline runs stay buffered and are merged into one more run when it finishes.
+    """
     try:
-        messages = message_buffer.pop(user_id, [])
-        if not messages:
-            return # nothing to process
-        
-        timers.pop(user_id, None)
-
-        text_messages = " ".join(m["incoming_msg"] for m in messages if m["incoming_msg"])
-        image_data_url = next((m["image_data_url"] for m in reversed(messages) if m["image_data_url"]), None)
-        voice_data_filename = next((m["voice_data_filename"] for m in reversed(messages) if m["voice_data_filename"]), None)
-
-        return start_process(
-            resp, user, user_id, record_user_id,
-            text_messages, is_test, image_data_url, voice_data_filename,
-            twilio_number, is_assistant, prompt_type
-        )
+        result = None
+        while True:
+            token = acquire_lease(user_id)
+            if not token:
+                mark_pipeline_pending(user_id)
+                if is_pipeline_running(user_id):
+                    print(f"[BUFFER] Pipeline already running for {user_id}, messages will be merged into its next run", flush=True)
+                    return result
+                continue # the running pipeline finished in the meantime, try again
+
+            try:
+                pop_pipeline_pending(user_id)
+                messages = take_buffered_messages(user_id, force)
+                if messages:
+                    text_messages = " ".join(m["incoming_msg"] for m in messages if m["incoming_msg"])
+                    image_data_url = next((m["image_data_url"] for m in reversed(messages) if m["image_data_url"]), None)
+                    voice_data_filename = next((m["voice_data_filename"] for m in reversed(messages) if m["voice_data_filename"]), None)
+
+                    try:
+                        result = start_process(
+                            resp, user, user_id, record_user_id,
+                            text_messages, is_test, image_data_url, voice_data_filename,
+                            twilio_number, is_assistant, prompt_type
+                        )
+                    except Exception as e:
+                        # messages buffered during the failed run are still processed below
+                        print(f"[BUFFER] Error processing messages for {user_id}: {e}", flush=True)
+                        set_sentry_context(user_id, text_messages, None, f"Error in process_buffered_messages function: start_process failed", e)
+                        result = ''
+            finally:
+                release_lease(user_id, token)
+
+            if not pop_pipeline_pending(user_id):
+                return result
+            force = True # messages arrived during the run, process them now
     except Exception as e:
         print(f"[BUFFER] Error in process_buffered_messages: {e}", flush=True)
         set_sentry_context(user_id, None, None, f"Error in process_buffered_messages function: Failed to process messages", e)
         return ''
+
+def take_buffered_messages(user_id, force=False):
+    """
+    Take the user's buffered messages from the local and the redis buffer, oldest first.
+    Returns None when the burst is still open, unless force is set.
+    """
+    with buffer_lock:
+        messages = message_buffer.pop(user_id, [])
+    if BUFFER_BACKEND != "redis":
+        return messages
+
+    try:
+        claimed = claim_messages_redis(user_id, force)
+    except Exception as e:
+        print(f"[BUFFER] Error claiming redis buffer for {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in take_buffered_messages function: Failed to claim redis buffer", e)
+        claimed = []
+
+    if claimed is None and not messages:
+        print(f"[BUFFER] Burst for {user_id} still open, leaving flush to the latest message", flush=True)
+        return None # another worker received a newer message and will flush
+    return sorted(messages + (claimed or []), key=lambda m: m["timestamp"])
+
+def acquire_lease(user_id):
+    try:
+        return acquire_pipeline_lease(user_id)
+    except Exception as e:
+        # without redis there is no cross-worker lease, run unguarded as before
+        print(f"[BUFFER] Error acquiring pipeline lease for {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in acquire_lease function: Failed to acquire pipeline lease", e)
+        return LOCAL_LEASE
+
+def release_lease(user_id, token):
+    if token == LOCAL_LEASE:
+        return
+    try:
+        release_pipeline_lease(user_id, token)
+    except Exception as e:
+        print(f"[BUFFER] Error releasing pipeline lease for {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in release_lease function: Failed to release pipeline lease", e)
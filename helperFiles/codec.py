@@ -0,0 +1,75 @@
+import base64
+import json
+import os
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # values are then packed as JSON
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Packed values look like "RCv1mz:<base85>": codec version, serializer (m msgpack, j json), compression (n none, z zlib, s zstd).
+# Base85 keeps them text, they are stored through the decode_responses client and may be encrypted afterwards.
+CODEC_VERSION = "RCv1"
+CODEC_HEADER_LENGTH = len(CODEC_VERSION) + 3
+
+SECURE_CODEC = os.environ.get("SECURE_CODEC", "msgpack")            # "msgpack" or "json"
+SECURE_COMPRESSION = os.environ.get("SECURE_COMPRESSION", "zlib")   # "zlib", "zstd" or "none"
+COMPRESS_MIN_BYTES = int(os.environ.get("SECURE_COMPRESS_MIN_BYTES", 128))  # smaller payloads do not shrink
+
+zstd_compressor = zstandard.ZstdCompressor(level=3) if zstandard else None
+zstd_decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+def serialize(value):
+    if SECURE_CODEC == "msgpack" and msgpack is not None:
+        return "m", msgpack.packb(value, use_bin_type=True, default=str)
+    return "j", json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+def compress(payload):
+    if len(payload) < COMPRESS_MIN_BYTES:
+        return "n", payload
+    if SECURE_COMPRESSION == "zstd" and zstd_compressor is not None:
+        return "s", zstd_compressor.compress(payload)
+    if SECURE_COMPRESSION in ("zlib", "zstd"):
+        return "z", zlib.compress(payload, 6)
+    return "n", payload
+
+def is_packed(text):
+    return isinstance(text, str) and text.startswith(CODEC_VERSION) and text[CODEC_HEADER_LENGTH - 1:CODEC_HEADER_LENGTH] == ":"
+
+def pack(value):
+    """
+    Text form of a value for redis: the packed form when it is shorter, otherwise the value itself (strings) or its JSON.
+    """
+    text = value if isinstance(value, str) else json.dumps(value)
+    serializer, payload = serialize(value)
+    compression, payload = compress(payload)
+    packed = f"{CODEC_VERSION}{serializer}{compression}:{base64.b85encode(payload).decode('ascii')}"
+    if len(packed) < len(text) or is_packed(text):
+        return packed
+    return text
+
+def unpack(text):
+    """
+    Value of a packed text, see is_packed.
+    """
+    serializer, compression = text[len(CODEC_VERSION)], text[len(CODEC_VERSION) + 1]
+    payload = base64.b85decode(text[CODEC_HEADER_LENGTH:])
+
+    if compression == "z":
+        payload = zlib.decompress(payload)
+    elif compression == "s":
+        if zstd_decompressor is None:
+            raise RuntimeError("zstandard is required to read this value")
+        payload = zstd_decompressor.decompress(payload)
+
+    if serializer == "m":
+        if msgpack is None:
+            raise RuntimeError("msgpack is required to read this value")
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
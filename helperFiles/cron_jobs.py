@@ -2,6 +2,7 @@ import os
 from datetime import datetime, timedelta, timezone as tzn
 from authorization.creds import *
 from authorization.auth import check_key_rotation_needed
+from helperFiles.key_rotation import start_key_rotation
 from helperFiles.helpers import send_whatsapp_message
 import time
 import requests
@@ -27,6 +28,12 @@ def check_key_rotation():
             )
         except Exception as e:
             print(f"########### Error sending key rotation notification: {e}", flush=True)
+
+    # Re-encrypt stored values once a new AES-GCM key version is deployed, a no-op once that run has finished
+    try:
+        start_key_rotation()
+    except Exception as e:
+        print(f"########### Error starting key rotation job: {e}", flush=True)
     
     # Update the last check date
     os.environ['LAST_KEY_ROTATION_CHECK_DATE'] = datetime.now(tzn.utc).strftime('%Y-%m-%d')
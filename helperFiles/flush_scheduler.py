@@ -0,0 +1,80 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from helperFiles.sentry_helper import set_sentry_context
+
+FLUSH_MAX_WORKERS = int(os.environ.get("FLUSH_MAX_WORKERS", 4))
+
+_heap = []          # (deadline, seq, user_id), may contain stale entries for rescheduled users
+_pending = {}       # user_id -> (seq, func, args), the only live flush per user
+_sequence = itertools.count()
+_condition = threading.Condition()
+_executor = ThreadPoolExecutor(max_workers=FLUSH_MAX_WORKERS, thread_name_prefix="buffer-flush")
+_scheduler_thread = None
+
+def schedule_flush(user_id, delay, func, args):
+    """
+    Schedule func(*args) to run after delay seconds, replacing any flush already scheduled for this user.
+    One scheduler thread serves every user, due flushes run on a bounded thread pool.
+    """
+    with _condition:
+        seq = next(_sequence)
+        _pending[user_id] = (seq, func, args)
+        heapq.heappush(_heap, (time.monotonic() + delay, seq, user_id))
+
+        # drop stale entries once they outnumber the live ones so memory stays proportional to active users
+        if len(_heap) > 2 * len(_pending) + 64:
+            _heap[:] = [entry for entry in _heap if _pending.get(entry[2], (None,))[0] == entry[1]]
+            heapq.heapify(_heap)
+
+        _ensure_scheduler_started()
+        _condition.notify()
+
+def cancel_flush(user_id):
+    with _condition:
+        return _pending.pop(user_id, None) is not None
+
+def pending_flush_count():
+    with _condition:
+        return len(_pending)
+
+def flush_backlog():
+    """
+    Flushes waiting for a pool thread plus flushes scheduled but not due yet, each one a pipeline about to run.
+    """
+    return _executor._work_queue.qsize() + pending_flush_count()
+
+def _ensure_scheduler_started():
+    # called with _condition held; also restarts the thread in a freshly forked gunicorn worker
+    global _scheduler_thread
+    if _scheduler_thread is None or not _scheduler_thread.is_alive():
+        _scheduler_thread = threading.Thread(target=_run_scheduler, name="buffer-flush-scheduler", daemon=True)
+        _scheduler_thread.start()
+
+def _run_scheduler():
+    while True:
+        with _condition:
+            while not _heap:
+                _condition.wait()
+
+            deadline, seq, user_id = _heap[0]
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                _condition.wait(wait)
+                continue
+
+            heapq.heappop(_heap)
+            pending = _pending.get(user_id)
+            if not pending or pending[0] != seq:
+                continue # rescheduled or cancelled
+            del _pending[user_id]
+
+        _, func, args = pending
+        try:
+            _executor.submit(func, *args)
+        except Exception as e:
+            print(f"[SCHEDULER] Error submitting flush for {user_id}: {e}", flush=True)
+            set_sentry_context(user_id, None, None, f"Error in flush scheduler: Failed to submit flush", e)
@@ -102,6 +102,10 @@ def extract_phone_number(user_id):
         raise ValueError("Invalid user ID format. Phone number not found.")
     
 def get_image_data_url(media_url, content_type, is_assistant=False):
+    """
+    Returns a public image URL for the assistant, otherwise a media store handle that is turned into a data URL at the OpenAI call.
+    """
+    from helperFiles.media_store import put_media
     try:
         allowed_types = {"image/png", "image/jpeg", "image/gif", "image/webp"}
         if content_type not in allowed_types:
@@ -117,23 +121,22 @@ def get_image_data_url(media_url, content_type, is_assistant=False):
             image_data_url = upload_to_cloudinary(image_bytes)
             is_accessible = is_image_accessible(image_data_url)
             print(f"########### Image accessible: {is_accessible}", flush=True)
-        else:        
-            image_data = base64.b64encode(response.content).decode('utf-8')
-            image_data_url = f"data:{content_type};base64,{image_data}"       
+        else:
+            image_data_url = put_media(response.content, content_type)
         return image_data_url
     except Exception as e:
         raise Exception(f"Error fetching media: {e}")
 
 def get_voice_data_url(media_url, content_type, user_id):
+    """
+    Returns a media store handle of the voice note, so any worker can transcribe it.
+    """
+    from helperFiles.media_store import put_media
     response = requests.get(media_url, auth=HTTPBasicAuth(TWILIO_SID, TWILIO_AUTH_TOKEN))
     if not response.headers["Content-Type"].startswith("audio/"):
         print("❌ Response Content-Type not audio:", response.headers["Content-Type"])
         return "Invalid audio file."
-    contentType = content_type.split("/")[-1]
-    filename = f"{user_id}_{uuid.uuid4().hex}.{contentType}"  # e.g., input.ogg, input.m4a
-    with open(filename, "wb") as f:
-        f.write(response.content)
-    return filename
+    return put_media(response.content, content_type)
 
 def transcribe_audio(voice_data_filename, client):
     print(f"########### Transcribing audio file: {voice_data_filename}", flush=True)
@@ -160,11 +163,19 @@ def convert_timezone(time_str, target_tz='Asia/Jakarta'):
         print(f"Error converting timezone: {e}")
         return None
 
+twilio_client = None  # reused across messages so the HTTP session stays open
+
+def get_twilio_client():
+    global twilio_client
+    if not twilio_client:
+        twilio_client = TwilioClient(TWILIO_SID, TWILIO_AUTH_TOKEN)
+    return twilio_client
+
 def send_whatsapp_message(to, message, twilio_number_main=TWILIO_PHONE_NUMBER):
     twilio_number = twilio_number_main if mode == 'production' else TWILIO_PHONE_NUMBER_SANDBOX
     print(f"########### Sending WhatsApp message from: {twilio_number} to {to}: {message}", flush=True)
     try: 
-        client = TwilioClient(TWILIO_SID, TWILIO_AUTH_TOKEN)
+        client = get_twilio_client()
         client.messages.create(
             from_=twilio_number,
             to=to,
@@ -275,14 +286,18 @@ def render_markdown_page(filepath, title):
 def parse_voice(voice_data_filename, client):
     """
     Parse the voice data filename to extract the actual filename.
+    A media store handle is first written to a temporary file.
     Ensures temporary files are cleaned up after use.
     """
+    from helperFiles.media_store import is_media_handle, materialize_media_file
     if not voice_data_filename:
         return None
 
     transcription = ""
     try:
         print(f"########### Entering with Voice data filename: {voice_data_filename}", flush=True)
+        if is_media_handle(voice_data_filename):
+            voice_data_filename = materialize_media_file(voice_data_filename, "voice")
         transcription = transcribe_audio(voice_data_filename, client)
     except Exception as e:
         print(f"########### Error transcribing audio: {str(e)}", flush=True)
@@ -0,0 +1,22 @@
+import json
+import pickle
+
+PICKLE_MARKER = b"\x80"  # first byte of every pickle written with protocol 2 or newer
+
+class CompactSerializer:
+    """
+    RQ serializer writing job payloads as compact JSON, so jobs must only carry primitive arguments (ids, strings, numbers).
+    Payloads written by the default pickle serializer are still read, so jobs queued by older releases keep working.
+    """
+    @staticmethod
+    def dumps(obj):
+        # default=str keeps a stray datetime or ObjectId in a job result from failing the job
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if data[:1] == PICKLE_MARKER:
+            return pickle.loads(data)
+        return json.loads(data)
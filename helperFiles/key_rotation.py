@@ -0,0 +1,234 @@
+import os
+import time
+from datetime import datetime, timezone as tzn
+from authorization import encryption
+from helperFiles.redis_helper import r, get_namespace_generations, key_generation
+from helperFiles.sentry_helper import set_sentry_context
+
+ROTATION_PHASES = ["chat", "draft", "tokens"]     # redis namespaces first, then the google tokens in mongo
+ROTATION_BATCH = int(os.environ.get("ROTATION_BATCH", 200))                          # keys per SCAN step, documents per mongo batch
+ROTATION_MAX_PER_SECOND = float(os.environ.get("ROTATION_MAX_PER_SECOND", 2000))     # values re-encrypted per second, keeps redis and mongo free for live traffic
+ROTATION_JOB_SECONDS = float(os.environ.get("ROTATION_JOB_SECONDS", 3))             # work done by one job before it queues the next, jobs behind it on the worker wait at most this long
+ROTATION_STALE_SECONDS = 600  # a run without a heartbeat for this long has died and may be resumed
+
+# Replace values that still hold what the job read, so a write made by live traffic in the meantime is never overwritten.
+# KEYS[1] is the key, ARGV[1] its type, then (slot, old, new) triples; slot is the list index or hash field, unused for strings.
+REWRITE_SCRIPT = r.register_script("""
+local kind = ARGV[1]
+local written = 0
+for i = 2, #ARGV, 3 do
+    local slot, old, new = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    if kind == 'string' then
+        if redis.call('GET', KEYS[1]) == old then
+            local ttl = redis.call('PTTL', KEYS[1])
+            redis.call('SET', KEYS[1], new)
+            if ttl > 0 then
+                redis.call('PEXPIRE', KEYS[1], ttl)
+            end
+            written = written + 1
+        end
+    elseif kind == 'list' then
+        if redis.call('LINDEX', KEYS[1], slot) == old then
+            redis.call('LSET', KEYS[1], slot, new)
+            written = written + 1
+        end
+    elseif kind == 'hash' then
+        if redis.call('HGET', KEYS[1], slot) == old then
+            redis.call('HSET', KEYS[1], slot, new)
+            written = written + 1
+        end
+    end
+end
+return written
+""")
+
+def checkpoint_key(version):
+    return f"rotation:v{version}"
+
+def get_rotation_status(version=None):
+    version = encryption.active_version if version is None else version
+    return r.hgetall(checkpoint_key(version)) if version is not None else {}
+
+def start_key_rotation():
+    """
+    Start re-encrypting stored values under the active key version, or resume a run that died.
+    Returns True when a job was queued.
+    """
+    from helperFiles.queue_helper import safe_enqueue
+    version = encryption.active_version
+    if version is None:
+        print("########### No AES-GCM key configured, nothing to rotate", flush=True)
+        return False
+
+    status = get_rotation_status(version)
+    if status.get("finished_at"):
+        return False
+    if status.get("waiting_phase"):
+        if status["waiting_phase"] == "tokens" and not encryption.uses_aesgcm(False):
+            print(f"########### Key rotation to version {version} is waiting: {status.get('waiting_reason')}", flush=True)
+            return False
+        r.hdel(checkpoint_key(version), "waiting_phase", "waiting_reason")
+    elif status and time.time() - float(status.get("heartbeat", 0)) < ROTATION_STALE_SECONDS:
+        return False # a run is in progress
+
+    if not status:
+        r.hset(checkpoint_key(version), mapping={"phase": ROTATION_PHASES[0], "cursor": "", "rewritten": 0, "skipped": 0, "started_at": datetime.now(tzn.utc).isoformat()})
+    r.hset(checkpoint_key(version), "heartbeat", time.time())
+    safe_enqueue(rotate_encryption_keys, version)
+    print(f"########### Key rotation to version {version} queued from phase {status.get('phase', ROTATION_PHASES[0])}", flush=True)
+    return True
+
+def throttle(started, processed):
+    ahead = processed / ROTATION_MAX_PER_SECOND - (time.monotonic() - started)
+    if ahead > 0:
+        time.sleep(ahead)
+
+def reencrypt(values, version, is_redis):
+    """
+    New ciphertexts for the values not yet under the key version, as {old: new}. Values that cannot be decrypted are left alone.
+    """
+    stale, plain = [], []
+    for value in set(values):
+        if encryption.key_version(value) == version:
+            continue
+        try:
+            plain.append(encryption.decrypt(value, is_redis))
+            stale.append(value)
+        except Exception as e:
+            print(f"❌ Error decrypting a value during key rotation: {e}", flush=True)
+    return dict(zip(stale, encryption.encrypt_many(plain, is_redis, version)))
+
+def rotate_redis_batch(namespace, cursor, version):
+    """
+    Re-encrypt the values of one SCAN step of a namespace. Returns (next cursor, rewritten, skipped).
+    """
+    cursor, keys = r.scan(int(cursor or 0), match=f"{namespace}:*", count=ROTATION_BATCH)
+    current = get_namespace_generations(namespace)[0]
+    keys = [key for key in keys if key_generation(namespace, key) >= current]  # older generations are being swept
+    if not keys:
+        return cursor, 0, 0
+
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+    kinds = pipe.execute()
+
+    for key, kind in zip(keys, kinds):
+        if kind == "list":
+            pipe.lrange(key, 0, -1)
+        elif kind == "hash":
+            pipe.hgetall(key)
+        else:
+            pipe.get(key)
+    raws = pipe.execute(raise_on_error=False)
+
+    slots = {}  # key -> [(slot, old value)]
+    for key, kind, raw in zip(keys, kinds, raws):
+        if isinstance(raw, Exception) or not raw:
+            continue # expired or changed type since the TYPE call, picked up by the next run if still there
+        items = raw.items() if kind == "hash" else enumerate(raw) if kind == "list" else [("", raw)]
+        slots[key] = [(slot, value) for slot, value in items if encryption.is_encrypted(value)]
+
+    rotated = reencrypt([value for items in slots.values() for _, value in items], version, True)
+    for key, kind in zip(keys, kinds):
+        args = [kind]
+        for slot, value in slots.get(key, []):
+            if value in rotated:
+                args += [slot, value, rotated[value]]
+        if len(args) > 1:
+            REWRITE_SCRIPT(keys=[key], args=args, client=pipe)
+    written = sum(pipe.execute())
+    attempted = sum(1 for items in slots.values() for _, value in items if value in rotated)
+    return cursor, written, attempted - written
+
+def rotate_tokens_batch(last_id, version):
+    """
+    Re-encrypt the google tokens of the next batch of token documents, in _id order. Returns (last _id, rewritten, skipped).
+    """
+    from bson import ObjectId
+    from pymongo import UpdateOne
+    from services.database import tokens_collection
+    query = {"_id": {"$gt": ObjectId(last_id) if ObjectId.is_valid(last_id) else last_id}} if last_id else {}
+    docs = list(tokens_collection.find(query, {"access_token": 1, "refresh_token": 1}).sort("_id", 1).limit(ROTATION_BATCH))
+    if not docs:
+        return None, 0, 0
+
+    fields = ("access_token", "refresh_token")
+    rotated = reencrypt([doc[field] for doc in docs for field in fields if doc.get(field)], version, False)
+    updates = []
+    for doc in docs:
+        changes = {field: rotated[doc[field]] for field in fields if doc.get(field) in rotated}
+        if changes:
+            # matches only while the tokens are unchanged, a refresh in the meantime already wrote the new scheme
+            updates.append(UpdateOne(dict({"_id": doc["_id"]}, **{field: doc[field] for field in changes}), {"$set": changes}))
+
+    written = tokens_collection.bulk_write(updates, ordered=False).modified_count if updates else 0
+    return str(docs[-1]["_id"]), written, len(updates) - written
+
+def rotate_encryption_keys(version):
+    """
+    Maintenance job re-encrypting chat and draft values in redis and the google tokens in mongo under a key version.
+    Progress is checkpointed after every batch in the rotation:v<version> hash, and the job continues in a new job
+    after ROTATION_JOB_SECONDS, so a failed or restarted worker resumes where it stopped.
+    """
+    from helperFiles.queue_helper import safe_enqueue
+    key = checkpoint_key(version)
+    status = r.hgetall(key)
+    if not status or status.get("finished_at"):
+        return 0
+    if version not in encryption.ciphers:
+        print(f"########### Key version {version} is not configured in this process, rotation not run", flush=True)
+        return 0
+
+    phase, cursor = status["phase"], status.get("cursor") or None
+    started, processed = time.monotonic(), 0
+    try:
+        while time.monotonic() - started < ROTATION_JOB_SECONDS:
+            if phase == "tokens" and not encryption.uses_aesgcm(False):
+                # the rotation is not complete: start_key_rotation resumes it here once tokens move to AES-GCM
+                reason = "AESGCM_FOR_TOKENS is off, google tokens stay on the legacy scheme"
+                r.hset(key, mapping={"waiting_phase": phase, "waiting_reason": reason, "heartbeat": time.time()})
+                print(f"########### Key rotation to version {version} stopped before the tokens: {reason}", flush=True)
+                return processed
+            if phase == "tokens":
+                cursor, written, skipped = rotate_tokens_batch(cursor, version)
+            else:
+                cursor, written, skipped = rotate_redis_batch(phase, cursor, version)
+                cursor = cursor or None
+
+            if cursor is None:
+                following = ROTATION_PHASES.index(phase) + 1
+                phase = ROTATION_PHASES[following] if following < len(ROTATION_PHASES) else None
+
+            pipe = r.pipeline(transaction=False)
+            pipe.hincrby(key, "rewritten", written)
+            pipe.hincrby(key, "skipped", skipped)
+            pipe.hset(key, mapping={"phase": phase or "", "cursor": cursor or "", "heartbeat": time.time()})
+            if phase is None:
+                pipe.hset(key, "finished_at", datetime.now(tzn.utc).isoformat())
+            pipe.execute()
+
+            if phase is None:
+                status = r.hgetall(key)
+                print(f"########### Key rotation to version {version} done: {status.get('rewritten')} values rewritten, {status.get('skipped')} changed meanwhile", flush=True)
+                return processed + written
+
+            processed += written + skipped
+            throttle(started, processed)
+    except Exception as e:
+        print(f"❌ Error in key rotation to version {version}: {e}", flush=True)
+        set_sentry_context(None, None, None, f"Error in rotate_encryption_keys function: Key rotation to version {version} stopped in phase {phase}", e)
+        raise
+
+    safe_enqueue(rotate_encryption_keys, version)
+    return processed
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Re-encrypt stored values under the active AES-GCM key version.")
+    parser.add_argument("command", choices=["start", "status"])
+    args = parser.parse_args()
+
+    if args.command == "start":
+        start_key_rotation()
+    print(get_rotation_status())
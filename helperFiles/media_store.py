@@ -0,0 +1,68 @@
+import base64
+import hashlib
+import mimetypes
+import os
+import uuid
+from helperFiles.redis_helper import r_worker, encode_secure, decode_secure
+
+MEDIA_TTL = int(os.environ.get("MEDIA_TTL", 60*60))  # media only has to outlive the buffer and the queued pipeline
+MEDIA_HANDLE_PREFIX = "media:"
+
+def put_media(data, content_type):
+    """
+    Store media bytes once under their content hash and return a small handle to pass through the pipeline instead of the bytes.
+    The bytes are stored base64 encoded through encode_secure, so they are encrypted like every other user value.
+    The handle ends with the byte size, so the buffer can account for the media without reading it back.
+    """
+    handle = f"{MEDIA_HANDLE_PREFIX}{hashlib.sha256(data).hexdigest()}:{len(data)}"
+    # same content already stored: only refresh its expiry
+    if r_worker.expire(handle, MEDIA_TTL):
+        return handle
+
+    pipe = r_worker.pipeline()
+    pipe.hset(handle, mapping={"content_type": content_type, "secure": encode_secure(handle, base64.b64encode(data).decode("ascii"))})
+    pipe.expire(handle, MEDIA_TTL)
+    pipe.execute()
+    print(f"########### Media stored: {handle} ({len(data)} bytes, {content_type})", flush=True)
+    return handle
+
+def is_media_handle(value):
+    return isinstance(value, str) and value.startswith(MEDIA_HANDLE_PREFIX)
+
+def media_size(value):
+    """
+    Bytes of the media behind a handle, the length of any other value (a URL or a local file name).
+    """
+    if not value:
+        return 0
+    if is_media_handle(value):
+        return int(value.rsplit(":", 1)[1])
+    return len(value)
+
+def get_media(handle):
+    """
+    Returns (bytes, content_type) of a stored media, raises when it expired.
+    """
+    secure, content_type = r_worker.hmget(handle, ["secure", "content_type"])
+    if secure is None:
+        raise ValueError(f"Media {handle} is no longer available")
+    return base64.b64decode(decode_secure(secure.decode("ascii"), as_text=True)), content_type.decode("utf-8")
+
+def get_media_data_url(handle):
+    """
+    Build the base64 data URL of a stored image, only at the point where it is sent to OpenAI.
+    """
+    data, content_type = get_media(handle)
+    return f"data:{content_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def materialize_media_file(handle, name_prefix="media"):
+    """
+    Write a stored media to a local temporary file, for APIs that need a file such as audio transcription.
+    The caller removes the file.
+    """
+    data, content_type = get_media(handle)
+    extension = content_type.split("/")[-1] or (mimetypes.guess_extension(content_type) or "").lstrip(".")
+    filename = f"{name_prefix}_{uuid.uuid4().hex}.{extension}"
+    with open(filename, "wb") as f:
+        f.write(data)
+    return filename
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from bson import json_util
+from helperFiles.redis_helper import r, user_key, encode_secure, decode_secure
+from helperFiles.sentry_helper import set_sentry_context
+
+PROFILE_LOCAL_TTL = float(os.environ.get("PROFILE_LOCAL_TTL", 5))    # seconds a process serves a profile without asking redis, bounds staleness across workers
+PROFILE_LOCAL_MAX = int(os.environ.get("PROFILE_LOCAL_MAX", 1024))   # profiles kept per process, least recently used are evicted
+PROFILE_REDIS_TTL = int(os.environ.get("PROFILE_REDIS_TTL", 300))
+PROFILE_TOMBSTONE = "-"      # written on invalidation so a read that started before the write cannot cache the old profile
+PROFILE_TOMBSTONE_TTL = 5
+
+local_profiles = OrderedDict()  # user_id -> (expires_at, profile)
+local_profiles_lock = threading.Lock()
+profile_cache_counts = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+def profile_key(user_id):
+    return user_key("profile", user_id)
+
+def count(event):
+    with local_profiles_lock:
+        profile_cache_counts[event] += 1
+
+def get_local_profile(user_id):
+    with local_profiles_lock:
+        entry = local_profiles.get(user_id)
+        if not entry:
+            return None
+        if entry[0] <= time.monotonic():
+            del local_profiles[user_id]
+            return None
+        local_profiles.move_to_end(user_id)
+        profile_cache_counts["local_hits"] += 1
+        return entry[1]
+
+def set_local_profile(user_id, profile):
+    with local_profiles_lock:
+        local_profiles[user_id] = (time.monotonic() + PROFILE_LOCAL_TTL, profile)
+        local_profiles.move_to_end(user_id)
+        while len(local_profiles) > PROFILE_LOCAL_MAX:
+            local_profiles.popitem(last=False)
+
+def get_cached_profile(user_id, load_profile):
+    """
+    Profile of a user from the process cache, then redis, then load_profile() (the mongo read).
+    Returns a copy, callers may change it freely.
+    """
+    profile = get_local_profile(user_id)
+    if profile is not None:
+        return dict(profile)
+
+    key = profile_key(user_id)
+    try:
+        raw = r.get(key)
+        if raw and raw != PROFILE_TOMBSTONE:
+            profile = json_util.loads(decode_secure(raw, as_text=True))
+            count("redis_hits")
+            set_local_profile(user_id, profile)
+            return dict(profile)
+    except Exception as e:
+        print(f"❌ Error reading cached profile for {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in get_cached_profile function: Failed to read cached profile", e)
+
+    count("misses")
+    profile = load_profile()
+    if profile is None:
+        return None
+
+    try:
+        # nx: never replaces a tombstone, the profile read here may predate that write
+        r.set(key, encode_secure(key, json_util.dumps(profile)), ex=PROFILE_REDIS_TTL, nx=True)
+    except Exception as e:
+        print(f"❌ Error caching profile for {user_id}: {e}", flush=True)
+    set_local_profile(user_id, profile)
+    return dict(profile)
+
+def invalidate_profile(user_id):
+    """
+    Drop a user's cached profile after a write. Other processes may serve their copy for up to PROFILE_LOCAL_TTL.
+    """
+    with local_profiles_lock:
+        local_profiles.pop(user_id, None)
+    try:
+        r.set(profile_key(user_id), PROFILE_TOMBSTONE, ex=PROFILE_TOMBSTONE_TTL)
+    except Exception as e:
+        print(f"❌ Error invalidating cached profile for {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in invalidate_profile function: Failed to invalidate cached profile", e)
+
+def get_profile_cache_stats():
+    with local_profiles_lock:
+        counts = dict(profile_cache_counts)
+        size = len(local_profiles)
+    reads = sum(counts.values())
+    return dict(counts, local_size=size, hit_ratio=round((counts["local_hits"] + counts["redis_hits"]) / reads, 3) if reads else None)
@@ -1,14 +1,234 @@
+import os
+import importlib
+import traceback
+import uuid
+from datetime import timedelta
 from rq import Queue
-from helperFiles.redis_helper import r_worker
+from rq.job import Job, JobStatus
+from rq.results import Result
+from rq.utils import now
+from helperFiles.redis_helper import r_worker, user_key
 from helperFiles.sentry_helper import set_sentry_context
+from helperFiles.spool import spool_job
+from helperFiles.job_serializer import CompactSerializer
 
-q = Queue("kalenda", connection=r_worker)
+# Workers drain these in strict priority order: user-facing replies first, then bookkeeping, then heavy maintenance
+QUEUE_NAMES = ["interactive", "bookkeeping", "maintenance"]
+LEGACY_QUEUE_NAME = "kalenda"  # still drained so jobs queued before the split are not lost
 
-def safe_enqueue(func, *args, **kwargs):
+queues = {name: Queue(name, connection=r_worker, serializer=CompactSerializer) for name in QUEUE_NAMES}
+q = Queue(LEGACY_QUEUE_NAME, connection=r_worker, serializer=CompactSerializer)
+
+# job type (function name) -> queue; unlisted jobs are treated as bookkeeping
+JOB_QUEUES = {
+    "run_process_job": "interactive",
+    "drain_lane": "interactive",
+    "rearm_lane": "interactive",
+    "add_interaction": "bookkeeping",
+    "flush_interactions": "bookkeeping",
+    "deduct_chat_balance": "bookkeeping",
+    "sweep_namespace_redis": "maintenance",
+    "rotate_encryption_keys": "maintenance",
+}
+DEFAULT_QUEUE_NAME = "bookkeeping"
+
+# seconds RQ keeps a finished job around; nothing reads results back, failed jobs are kept long enough to be requeued after an incident
+DEFAULT_JOB_TTLS = {"result_ttl": 60, "failure_ttl": 60*60*24*3}
+JOB_TTLS = {
+    "run_process_job": {"result_ttl": 0, "failure_ttl": 60*60*24},  # a reply requeued after a day is no use to the user
+    "drain_lane": {"result_ttl": 0, "failure_ttl": 60*60*24},
+    "rearm_lane": {"result_ttl": 0, "failure_ttl": 60*60*24},
+    "add_interaction": {"result_ttl": 0, "failure_ttl": 60*60*24*7},
+    "flush_interactions": {"result_ttl": 0, "failure_ttl": 60*60*24*7},
+    "deduct_chat_balance": {"result_ttl": 0, "failure_ttl": 60*60*24*7},
+}
+
+LANE_JOB_TIMEOUT = int(os.environ.get("LANE_JOB_TIMEOUT", 300))  # seconds allowed for a single job in a lane
+LANE_BATCH_SIZE = int(os.environ.get("LANE_BATCH_SIZE", 5))      # jobs a drainer runs before yielding the worker to other users
+LANE_ACTIVE_TTL = LANE_JOB_TIMEOUT + 60                          # lets a lane recover if its drainer dies mid-job
+
+# Called by a drainer that found the lane empty: release the lane unless a job was pushed in the meantime.
+RELEASE_LANE_SCRIPT = r_worker.register_script("""
+if redis.call('LLEN', KEYS[1]) > 0 then
+    return 1
+end
+redis.call('DEL', KEYS[2])
+return 0
+""")
+
+# Replace the job id of a lost queued drainer, unless another enqueue or the drainer itself changed the lane meanwhile.
+TAKE_OVER_LANE_SCRIPT = r_worker.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] and redis.call('PTTL', KEYS[1]) == -1 then
+    redis.call('SET', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+""")
+
+# keyword arguments consumed by q.enqueue itself, they must not reach the job function when it runs locally
+RQ_ENQUEUE_OPTIONS = {"job_timeout", "result_ttl", "ttl", "failure_ttl", "description", "job_id", "at_front", "meta", "retry", "depends_on", "on_success", "on_failure"}
+
+def get_queue(func, queue_name=None):
+    """
+    Pick the queue for a job from its type, unless a queue is named explicitly.
+    """
+    return queues[queue_name or JOB_QUEUES.get(func.__name__, DEFAULT_QUEUE_NAME)]
+
+def job_options(func, kwargs):
+    """
+    Add the result and failure TTLs of the job type, options passed by the caller win.
+    """
+    return {**JOB_TTLS.get(func.__name__, DEFAULT_JOB_TTLS), **kwargs}
+
+def safe_enqueue(func, *args, queue_name=None, **kwargs):
+    """
+    Queue a job on the queue of its type. Arguments are serialized as JSON, pass ids instead of documents.
+    """
+    queue = get_queue(func, queue_name)
+    kwargs = job_options(func, kwargs)
     try:
-        print("Adding interaction to queue")
-        return q.enqueue(func, *args, **kwargs)
+        print(f"Adding {func.__name__} to {queue.name} queue")
+        return queue.enqueue(func, *args, **kwargs)
+    except Exception as e:
+        if queue.name != "interactive":
+            # background work waits in the local spool instead of slowing down the request
+            try:
+                print("RQ failed, spooling job")
+                set_sentry_context(None, None, None, f"Error in adding {func.__name__} to queue -- spooled", e)
+                return spool_job(queue.name, func, args, kwargs)
+            except Exception as spool_error:
+                print(f"Spool failed: {spool_error}")
+
+        print("RQ failed, running locally")
+        set_sentry_context(None, None, None, f"Error in adding {func.__name__} to queue -- running locally", e)
+        job_kwargs = {k: v for k, v in kwargs.items() if k not in RQ_ENQUEUE_OPTIONS}
+        return func(*args, **job_kwargs)
+
+def safe_enqueue_in(seconds, func, *args, queue_name=None, **kwargs):
+    """
+    Schedule a job to be queued after a delay (needs a worker running with the RQ scheduler), runs it locally if redis is unavailable.
+    """
+    try:
+        queue = get_queue(func, queue_name)
+        kwargs = job_options(func, kwargs)
+        print(f"Scheduling {func.__name__} on {queue.name} queue in {seconds}s")
+        return queue.enqueue_in(timedelta(seconds=seconds), func, *args, **kwargs)
     except Exception as e:
         print("RQ failed, running locally")
-        set_sentry_context(None, None, None, f"Error in adding interaction to queue -- running locally", e)
+        set_sentry_context(None, None, None, f"Error in scheduling {func.__name__} -- running locally", e)
+        job_kwargs = {k: v for k, v in kwargs.items() if k not in RQ_ENQUEUE_OPTIONS}
+        return func(*args, **job_kwargs)
+
+#### Per-user lanes ####
+
+def lane_keys(user_id):
+    return [user_key("lane", user_id), user_key("lane_active", user_id)]
+
+def enqueue_in_lane(user_id, func, *args, **kwargs):
+    """
+    Queue a job behind the other jobs of the same user.
+    Jobs of one user run one at a time in arrival order, while different users are drained by different workers in parallel.
+    """
+    lane_key, _ = lane_keys(user_id)
+    try:
+        r_worker.rpush(lane_key, CompactSerializer.dumps([f"{func.__module__}.{func.__name__}", args, kwargs]))
+    except Exception as e:
+        print(f"Lane unavailable for {user_id}, running locally")
+        set_sentry_context(user_id, None, None, f"Error in adding {func.__name__} to user lane -- running locally", e)
         return func(*args, **kwargs)
+
+    try:
+        # only the enqueue that activates the lane starts a drainer, the others ride along
+        return start_drainer(user_id)
+    except Exception as e:
+        print(f"Error activating lane for {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in enqueue_in_lane function: Failed to activate lane", e)
+
+def is_drainer_lost(job_id):
+    job = Job.fetch_many([job_id], connection=r_worker, serializer=CompactSerializer)[0]
+    return job is None or job.get_status(refresh=False) in (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED, JobStatus.FINISHED)
+
+def start_drainer(user_id):
+    """
+    Queue a drainer for a lane unless one is already queued or running. Returns the drainer job, None when there already is one.
+    While queued the lane_active flag holds the drainer's job id without a TTL, so a long queue cannot expire it;
+    the drainer puts a TTL on it once it runs, which frees the lane if the drainer dies mid-job.
+    """
+    lane_key, active_key = lane_keys(user_id)
+    job_id = f"drain-{uuid.uuid4().hex}"
+    if not r_worker.set(active_key, job_id, nx=True):
+        queued_id = r_worker.get(active_key)
+        if queued_id is None or r_worker.ttl(active_key) != -1 or not is_drainer_lost(queued_id.decode()):
+            return None
+        # the queued drainer was lost (failed, or evicted from redis), take the lane over
+        if not TAKE_OVER_LANE_SCRIPT(keys=[active_key], args=[queued_id, job_id]):
+            return None
+
+    job = safe_enqueue(drain_lane, user_id, job_id=job_id, job_timeout=LANE_JOB_TIMEOUT * LANE_BATCH_SIZE)
+    # re-arms the lane if this drainer dies before emptying it
+    safe_enqueue_in(LANE_ACTIVE_TTL, rearm_lane, user_id)
+    return job
+
+def rearm_lane(user_id):
+    """
+    Watchdog job: start a new drainer for a lane whose drainer died with jobs left, otherwise look again later while it is busy.
+    """
+    lane_key, _ = lane_keys(user_id)
+    if not r_worker.llen(lane_key):
+        return
+    if start_drainer(user_id) is None:
+        safe_enqueue_in(LANE_ACTIVE_TTL, rearm_lane, user_id)
+    else:
+        print(f"########### Re-armed lane of {user_id}", flush=True)
+
+def drain_lane(user_id):
+    """
+    RQ job running the queued jobs of one user in order.
+    """
+    lane_key, active_key = lane_keys(user_id)
+    for _ in range(LANE_BATCH_SIZE):
+        r_worker.expire(active_key, LANE_ACTIVE_TTL)
+        item = r_worker.lpop(lane_key)
+        if item is None:
+            if RELEASE_LANE_SCRIPT(keys=[lane_key, active_key]) == 0:
+                return
+            continue
+        run_lane_job(user_id, item)
+
+    # lane still busy: continue in a fresh job so other users' lanes get a turn on this worker
+    job_id = f"drain-{uuid.uuid4().hex}"
+    r_worker.set(active_key, job_id)  # queued again, no TTL until the next drainer runs
+    safe_enqueue(drain_lane, user_id, job_id=job_id, job_timeout=LANE_JOB_TIMEOUT * LANE_BATCH_SIZE)
+
+def run_lane_job(user_id, item):
+    func_path, args, kwargs = CompactSerializer.loads(item)
+    try:
+        module_name, func_name = func_path.rsplit(".", 1)
+        func = getattr(importlib.import_module(module_name), func_name)
+        return func(*args, **kwargs)
+    except Exception as e:
+        # a failing job must not block the jobs queued behind it, it is parked in the failed registry instead
+        print(f"Error running lane job for {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in run_lane_job function: Lane job failed", e)
+        try:
+            record_failed_lane_job(func_path, args, kwargs, traceback.format_exc())
+        except Exception as record_error:
+            print(f"Error recording failed lane job for {user_id}: {record_error}", flush=True)
+
+def record_failed_lane_job(func_path, args, kwargs, exc_string):
+    """
+    Add a lane job that raised to the failed registry of its queue, where queue_admin lists and requeues it like any failed job.
+    A requeued lane job runs on its own, outside the lane.
+    """
+    func_name = func_path.rsplit(".", 1)[-1]
+    queue = queues[JOB_QUEUES.get(func_name, DEFAULT_QUEUE_NAME)]
+    ttls = JOB_TTLS.get(func_name, DEFAULT_JOB_TTLS)
+    job = queue.create_job(func_path, args=args, kwargs=kwargs, **ttls)
+    job.ended_at = now()
+
+    pipe = r_worker.pipeline()
+    job.set_status(JobStatus.FAILED, pipeline=pipe)
+    queue.failed_job_registry.add(job, ttl=ttls["failure_ttl"], exc_string=exc_string, pipeline=pipe)
+    Result.create_failure(job, ttls["failure_ttl"], exc_string, pipeline=pipe)
+    pipe.execute()
+    return job
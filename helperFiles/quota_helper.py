@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta, timezone as tzn
+from helperFiles.redis_helper import r, user_key
+from helperFiles.sentry_helper import set_sentry_context
+from services.database import user_collection, DAILY_CHAT_LIMIT
+
+QUOTA_TIMEZONE = tzn(timedelta(hours=7))  # balances reset at midnight GMT+7, same as check_user
+QUOTA_KEY_TTL = 60*60*48
+
+# Daily token bucket per user, checked and decremented in one round trip.
+# KEYS[1] quota hash; ARGV: today, daily capacity, cost, seed balance ('' when not known yet).
+# Returns {1, remaining} when admitted, {0, remaining} when rejected, {-1, 0} when the bucket must be seeded from mongo.
+TAKE_CHAT_TOKEN_SCRIPT = r.register_script("""
+local day = redis.call('HGET', KEYS[1], 'day')
+local tokens
+if day == ARGV[1] then
+    tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+elseif not day then
+    if ARGV[4] == '' then
+        return {-1, 0}
+    end
+    tokens = tonumber(ARGV[4])
+else
+    tokens = tonumber(ARGV[2])
+end
+
+local admitted = 0
+if tokens >= tonumber(ARGV[3]) then
+    tokens = tokens - tonumber(ARGV[3])
+    admitted = 1
+end
+redis.call('HSET', KEYS[1], 'day', ARGV[1], 'tokens', tokens)
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return {admitted, tokens}
+""")
+
+def quota_today():
+    return datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+def get_seed_balance(user_id, today):
+    """
+    Starting balance of a bucket that is not in redis yet: the mongo balance if it was reset today, a full day otherwise.
+    """
+    user = user_collection.find_one({"user_id": user_id}, {"chat_balance": 1, "last_balance_reset": 1})
+    if not user:
+        return DAILY_CHAT_LIMIT
+
+    last_balance_reset = user.get("last_balance_reset")
+    if not last_balance_reset:
+        return DAILY_CHAT_LIMIT
+    if last_balance_reset.tzinfo is None:
+        last_balance_reset = last_balance_reset.replace(tzinfo=tzn.utc)
+
+    if last_balance_reset.astimezone(QUOTA_TIMEZONE).date().isoformat() != today:
+        return DAILY_CHAT_LIMIT
+    return max(int(user.get("chat_balance", DAILY_CHAT_LIMIT)), 0)
+
+def admit_chat(user_id, user_type='regular'):
+    """
+    Take one chat from the user's daily quota before any LLM call.
+    Returns (admitted, remaining). Mongo is brought in line afterwards by the deduct_chat_balance job.
+    """
+    if user_type == 'unlimited':
+        return True, None
+
+    key = user_key("quota", user_id)
+    today = quota_today()
+    try:
+        admitted, remaining = TAKE_CHAT_TOKEN_SCRIPT(keys=[key], args=[today, DAILY_CHAT_LIMIT, 1, '', QUOTA_KEY_TTL])
+        if admitted == -1:
+            seed = get_seed_balance(user_id, today)
+            admitted, remaining = TAKE_CHAT_TOKEN_SCRIPT(keys=[key], args=[today, DAILY_CHAT_LIMIT, 1, seed, QUOTA_KEY_TTL])
+
+        print(f"########### Quota for {user_id}: admitted={bool(admitted)}, remaining={remaining}", flush=True)
+        return admitted == 1, remaining
+    except Exception as e:
+        # fail open: the webhook already checked the mongo balance
+        print(f"❌ Error checking quota for user {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in admit_chat function: Failed to check quota", e)
+        return True, None
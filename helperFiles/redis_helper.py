@@ -1,38 +1,135 @@
 import redis
 import json
 import os
+import re
+import time
+import uuid
 from authorization.creds import REDIS_HOST, REDIS_PASSWORD, REDIS_PORT, redis_encryption_non_admin, redis_encryption_all, no_redis_encryption
 from helperFiles.helpers import send_error_whatsapp_message, extract_phone_number
 from helperFiles.sentry_helper import set_sentry_context
+from helperFiles.codec import pack, unpack, is_packed
+from authorization import encryption
 from datetime import datetime, timezone as tzn, timedelta
 from cryptography.fernet import Fernet
 import os
 from authorization.creds import ADMIN_NUMBER
 
-r = redis.Redis(
-    host=REDIS_HOST,
-    port=REDIS_PORT,
-    password=REDIS_PASSWORD,
-    ssl=True,
-    decode_responses=True
-)
-
-r_worker = redis.Redis(
-    host=REDIS_HOST,
-    port=REDIS_PORT,
-    password=REDIS_PASSWORD,
-    ssl=True,
-    decode_responses=False  # must be False for RQ
-)
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))                # per pool and process
+REDIS_POOL_TIMEOUT = int(os.environ.get("REDIS_POOL_TIMEOUT", 5))                       # seconds to wait for a free connection
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get("REDIS_CONNECT_TIMEOUT", 5))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30))  # idle connections are pinged before reuse
+
+def make_redis_pool(decode_responses, socket_timeout=REDIS_SOCKET_TIMEOUT, max_connections=REDIS_MAX_CONNECTIONS):
+    """
+    Bounded TLS connection pool. When every connection is busy a caller waits up to REDIS_POOL_TIMEOUT instead of opening more.
+    """
+    return redis.BlockingConnectionPool(
+        connection_class=redis.SSLConnection,
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        password=REDIS_PASSWORD,
+        max_connections=max_connections,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        decode_responses=decode_responses
+    )
+
+r = redis.Redis(connection_pool=make_redis_pool(decode_responses=True))
+r_worker = redis.Redis(connection_pool=make_redis_pool(decode_responses=False))  # must be False for RQ
+
+def make_worker_connection():
+    """
+    Connection for the RQ worker loop only. RQ raises its socket timeout above the blocking dequeue timeout,
+    so it gets its own small pool instead of changing the timeout of r_worker for the jobs.
+    """
+    return redis.Redis(connection_pool=make_redis_pool(decode_responses=False, socket_timeout=None, max_connections=4))
 
 CLEAN_ADMIN_NUMBER = extract_phone_number(ADMIN_NUMBER)
 
+PIPELINE_LEASE_TTL = int(os.environ.get("PIPELINE_LEASE_TTL", 300))  # longer than any LLM pipeline, expires if its holder dies
+
+# Delete a lease only if it is still held by the caller's token
+RELEASE_LEASE_SCRIPT = r.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+MESSAGE_SID_TTL = int(os.environ.get("MESSAGE_SID_TTL", 60*60*24))  # twilio retries well within a day
+DUPLICATE_MESSAGES_KEY = "metrics:duplicate_messages_suppressed"
+
+# Chat and draft keys written before hash tags (chat:62) are renamed to their new key (chat:{62}) when first read.
+# Costs a RENAMENX per key on every read: enable it only for the first day after deploying hash-tagged keys, the old
+# keys expire with CHAT_MEMORY_TTL and DRAFT_TTL. Must be disabled before moving to Redis Cluster, a rename across slots fails there.
+LEGACY_KEY_FALLBACK = os.environ.get("REDIS_LEGACY_KEY_FALLBACK", "false").lower() == "true"
+
+# Namespaces whose keys carry a generation: chat:{<user_id>} at generation 0, chat:v{n}:{<user_id>} after n clears.
+# Clearing a namespace only bumps its generation, old keys are unlinked later by a maintenance job.
+NAMESPACE_CACHE_SECONDS = 5       # how long a process keeps using a generation before checking it again
+NAMESPACE_SWEEP_BATCH = 500       # keys per SCAN step of the sweeper
+NAMESPACE_SWEEP_STEPS = 20        # SCAN steps per sweeper job before it continues in a new job
+namespace_generations_cache = {}  # namespace -> (generation, checked_at)
+
+DRAFT_TTL = 60*60*24
+# draft fields the prompts render, read with HMGET so bookkeeping fields stay in redis
+DRAFT_PROMPT_FIELDS = ["name", "start_date", "end_date", "location", "description", "participants", "timezone", "calendar", "reminder", "send_updates", "recurrence", "status"]
+
+# Set some fields of an existing draft hash and renew its expiry. Returns 0 when there is no draft,
+# -1 when the draft is still stored as a single string (before drafts were hashes).
+UPDATE_DRAFT_FIELDS_SCRIPT = r.register_script("""
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind ~= 'hash' then
+    if kind == 'none' then
+        return 0
+    end
+    return -1
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+""")
+
+MAX_CHAT_STORED = 3
+CHAT_MEMORY_TTL = 60*60*24  # conversations older than a day are not used as context
+
+# Append one encrypted conversation to a user's memory list, keep the newest entries and renew the expiry.
+# A memory still stored as a single JSON string (before it was a list) is replaced.
+ADD_CHAT_SCRIPT = r.register_script("""
+if redis.call('TYPE', KEYS[1])['ok'] == 'string' then
+    redis.call('DEL', KEYS[1])
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return redis.call('LLEN', KEYS[1])
+""")
+
+def user_key(prefix, user_id):
+    """
+    Key of a per-user value. The user id is a hash tag, so all keys of a user live in the same
+    cluster slot and can be used together in pipelines and Lua scripts.
+    """
+    return f"{prefix}:{{{user_id}}}"
+
+def legacy_user_key(key):
+    # layout before hash tags: chat:{62} was chat:62
+    return key.replace("{", "").replace("}", "")
+
+def key_user_id(key):
+    # the user id is the last segment, so chat:v2:{<id>} resolves like chat:{<id>} and the old chat:<id>
+    return key.rsplit(':', 1)[1].strip("{}") if ':' in key else None
+
 def is_not_user_admin(key):
     # return False # allow debug for beta testing
     if redis_encryption_all:
         return True
     elif redis_encryption_non_admin:
-        user_id = key.split(':')[1] if ':' in key else None
+        user_id = key_user_id(key)
         if user_id and user_id != CLEAN_ADMIN_NUMBER:
             return True
         return False
@@ -42,54 +139,204 @@ def is_not_user_admin(key):
         return False
 
 def is_encrypted(value):
-    return isinstance(value, str) and value.startswith("RENC_v")
+    return encryption.is_encrypted(value)
+
+def encode_secure(key, value):
+    """
+    Serialize a value for storage, packed by the codec when that is shorter, and encrypt it when the key requires it.
+    """
+    value = pack(value)
+
+    if is_not_user_admin(key):
+        return encryption.encrypt(value, True)
+    return value
+
+def decode_secure(raw, as_text=False):
+    """
+    Decrypt a stored value if needed and read it back from its packed form or from JSON when possible.
+    With as_text the stored text is returned without parsing it, for values in another format (e.g. bson json).
+    """
+    if not raw:
+        return None
+
+    decrypted = encryption.decrypt(raw, True) if is_encrypted(raw) else raw
+    if is_packed(decrypted):
+        return unpack(decrypted)
+    if as_text:
+        return decrypted
 
-def add_secure(key, value, ttl=None):
-    from authorization.auth import encrypt_token
     try:
-        if not isinstance(value, str):
-            value = json.dumps(value)
+        return json.loads(decrypted)
+    except json.JSONDecodeError:
+        return decrypted
 
-        if is_not_user_admin(key): 
-            encrypted = encrypt_token(value, True)
-            if ttl:
-                r.set(key, encrypted, ex=ttl)
-            else:
-                r.set(key, encrypted)
+def add_secure(key, value, ttl=None):
+    try:
+        stored = encode_secure(key, value)
+        if ttl:
+            r.set(key, stored, ex=ttl)
         else:
-            if ttl:
-                r.set(key, value, ex=ttl)
-            else:
-                r.set(key, value)
+            r.set(key, stored)
 
     except Exception as e:
         print(f"❌ Error adding secure value for key {key}: {e}", flush=True)
         set_sentry_context(None, None, None, f"Encryption failed in add_secure for key '{key}'. Falling back to plaintext storage.", e)
-        r.set(key, value)
+        r.set(key, value if isinstance(value, str) else json.dumps(value))
 
 def get_secure(key):
-    from authorization.auth import decrypt_token
     try:
         encrypted = r.get(key)
         
         if encrypted:
-            if is_encrypted(encrypted):
-                print(f"########### Decrypting value for key: {key}", flush=True)
-                decrypted = decrypt_token(encrypted, True)
-                print(f"########### Decrypted value for key: {key}", flush=True)
-            else:
-                decrypted = encrypted
-
-            try:
-                return json.loads(decrypted)
-            except json.JSONDecodeError:
-                return decrypted
+            return decode_secure(encrypted)
         return None
     except Exception as e:
         print(f"❌ Error retrieving secure value for key {key}: {e}", flush=True)
         set_sentry_context(None, None, None, f"Encryption failed in get_secure for key '{key}'. Falling back to plaintext storage.", e)
         return r.get(key)
 
+def decode_secure_value(key, raw):
+    try:
+        return decode_secure(raw)
+    except Exception as e:
+        print(f"❌ Error decoding secure value for key {key}: {e}", flush=True)
+        set_sentry_context(None, None, None, f"Decryption failed for key '{key}'. Falling back to the stored value.", e)
+        return raw
+
+def encode_secure_field(key, value):
+    # wrapped in a list so a text field never comes back as a number or boolean from decode_secure
+    return encode_secure(key, [value])
+
+def decode_secure_field(key, raw):
+    value = decode_secure_value(key, raw)
+    return value[0] if isinstance(value, list) and len(value) == 1 else value
+
+def get_secure_many(keys, list_keys=(), hash_keys=None):
+    """
+    Fetch several keys in one round trip and decode them in a single pass.
+    Keys in list_keys hold lists of secure entries and come back as lists.
+    Keys in hash_keys hold hashes of secure fields and come back as dicts; hash_keys maps each key
+    to the fields to read, or None for all of them.
+    Returns the values in the order of the keys, None for missing keys; a key of the wrong type returns its redis error.
+    """
+    if not keys:
+        return []
+    hash_keys = hash_keys or {}
+
+    if list_keys or hash_keys or LEGACY_KEY_FALLBACK:
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            if LEGACY_KEY_FALLBACK:
+                pipe.renamenx(legacy_user_key(key), key)  # fails harmlessly when there is no old key
+            if key in list_keys:
+                pipe.lrange(key, 0, -1)
+            elif key in hash_keys and hash_keys[key]:
+                pipe.hmget(key, hash_keys[key])
+            elif key in hash_keys:
+                pipe.hgetall(key)
+            else:
+                pipe.get(key)
+        raws = pipe.execute(raise_on_error=False)
+        if LEGACY_KEY_FALLBACK:
+            raws = raws[1::2]
+    else:
+        raws = r.mget(keys)
+
+    decrypted = decrypt_all(raws)
+    values = []
+    for key, raw in zip(keys, raws):
+        if isinstance(raw, Exception):
+            values.append(raw)
+        elif key in hash_keys:
+            if isinstance(raw, list):
+                raw = dict(zip(hash_keys[key], raw))
+            values.append({field: decode_secure_field(key, decrypted.get(item, item)) for field, item in raw.items() if item is not None})
+        elif isinstance(raw, list):
+            values.append([decode_secure_value(key, decrypted.get(item, item)) for item in raw])
+        else:
+            values.append(decode_secure_value(key, decrypted.get(raw, raw)))
+    return values
+
+def decrypt_all(raws):
+    """
+    Plaintext of every encrypted value in raws (strings, lists or hashes), decrypted in one batch.
+    On a failure nothing is returned and each value is decrypted on its own, so only the broken ones fall back.
+    """
+    encrypted = set()
+    for raw in raws:
+        items = raw.values() if isinstance(raw, dict) else raw if isinstance(raw, list) else [raw]
+        encrypted.update(item for item in items if is_encrypted(item))
+    encrypted = list(encrypted)
+    try:
+        return dict(zip(encrypted, encryption.decrypt_many(encrypted, True)))
+    except Exception:
+        return {}
+
+#### Redis Namespace Functions ####
+
+def get_namespace_generations(*namespaces):
+    """
+    Current generation of each namespace, read from redis at most every NAMESPACE_CACHE_SECONDS per process.
+    """
+    now = time.monotonic()
+    stale = [ns for ns in namespaces if now - namespace_generations_cache.get(ns, (0, float("-inf")))[1] >= NAMESPACE_CACHE_SECONDS]
+    if stale:
+        try:
+            for ns, generation in zip(stale, r.mget([f"ns:{ns}" for ns in stale])):
+                namespace_generations_cache[ns] = (int(generation or 0), now)
+        except Exception as e:
+            # keep using the last known generation until redis answers again
+            print(f"❌ Error reading namespace generations: {e}", flush=True)
+            if any(ns not in namespace_generations_cache for ns in stale):
+                raise
+    return [namespace_generations_cache[ns][0] for ns in namespaces]
+
+def namespaced_key(namespace, user_id, generation=None):
+    if generation is None:
+        generation = get_namespace_generations(namespace)[0]
+    return user_key(namespace if generation == 0 else f"{namespace}:v{generation}", user_id)
+
+def chat_key(user_id):
+    return namespaced_key("chat", user_id)
+
+def draft_key(user_id):
+    return namespaced_key("draft", user_id)
+
+def key_generation(namespace, key):
+    match = re.match(rf"{re.escape(namespace)}:v(\d+):", key)
+    return int(match.group(1)) if match else 0
+
+def clear_namespace_redis(namespace):
+    """
+    Drop every key of a namespace at once by moving it to a new generation. Returns the new generation.
+    """
+    from helperFiles.queue_helper import safe_enqueue_in
+    generation = r.incr(f"ns:{namespace}")
+    namespace_generations_cache[namespace] = (generation, time.monotonic())
+    # other processes may write to the old generation until their cached generation expires
+    safe_enqueue_in(NAMESPACE_CACHE_SECONDS * 2, sweep_namespace_redis, namespace)
+    return generation
+
+def sweep_namespace_redis(namespace, cursor=0):
+    """
+    Maintenance job unlinking the keys of older generations of a namespace in small SCAN batches,
+    continuing in a new job until the scan is complete. Returns the number of keys unlinked.
+    """
+    from helperFiles.queue_helper import safe_enqueue
+    current = int(r.get(f"ns:{namespace}") or 0)
+    unlinked = 0
+    for _ in range(NAMESPACE_SWEEP_STEPS):
+        cursor, keys = r.scan(cursor, match=f"{namespace}:*", count=NAMESPACE_SWEEP_BATCH)
+        stale = [key for key in keys if key_generation(namespace, key) < current]
+        if stale:
+            unlinked += r.unlink(*stale)
+        if not cursor:
+            print(f"########### Namespace {namespace} swept, {unlinked} keys unlinked by the last job", flush=True)
+            return unlinked
+
+    safe_enqueue(sweep_namespace_redis, namespace, cursor)
+    return unlinked
+
 def ping_redis():
     try:
         response = r.ping()
@@ -97,11 +344,64 @@ def ping_redis():
     except ConnectionError as e:
         return {"status": "error", "message": str(e)}, 500
 
+#### Redis Inbound Message Functions ####
+
+def claim_message_sid(message_sid):
+    """
+    Record a Twilio MessageSid the first time it is seen.
+    Returns False when the webhook is a retry of a message that was already accepted.
+    """
+    if not message_sid:
+        return True
+    try:
+        if r.set(f"msgsid:{message_sid}", 1, nx=True, ex=MESSAGE_SID_TTL):
+            return True
+        r.incr(DUPLICATE_MESSAGES_KEY)
+        return False
+    except Exception as e:
+        # fail open: processing a message twice is better than dropping it
+        print(f"❌ Error claiming message sid {message_sid}: {e}", flush=True)
+        set_sentry_context(None, None, None, f"Error in claim_message_sid function: Failed to record message sid", e)
+        return True
+
+def get_suppressed_duplicates_count():
+    try:
+        return int(r.get(DUPLICATE_MESSAGES_KEY) or 0)
+    except Exception as e:
+        print(f"❌ Error retrieving suppressed duplicates count: {e}", flush=True)
+        return None
+
+#### Redis Lease Functions ####
+
+def acquire_pipeline_lease(user_id):
+    """
+    Take the user's pipeline lease. Returns the lease token, or None while another pipeline of the user holds it.
+    """
+    token = uuid.uuid4().hex
+    if r.set(user_key("lease", user_id), token, nx=True, ex=PIPELINE_LEASE_TTL):
+        return token
+    return None
+
+def release_pipeline_lease(user_id, token):
+    RELEASE_LEASE_SCRIPT(keys=[user_key("lease", user_id)], args=[token])
+
+def is_pipeline_running(user_id):
+    return bool(r.exists(user_key("lease", user_id)))
+
+def mark_pipeline_pending(user_id):
+    # tells the running pipeline that new messages arrived and it should run once more
+    r.set(user_key("lease_pending", user_id), 1, ex=PIPELINE_LEASE_TTL)
+
+def pop_pipeline_pending(user_id):
+    return bool(r.delete(user_key("lease_pending", user_id)))
+
 #### Redis Chat Functions ####
 
 def add_user_chat_redis(user_id, input, answer, user_chats:list=[], update=True):
     """
-    Add a new conversation to a user's memory or create a new memory entry.
+    Append a conversation to a user's memory, a redis list of individually encrypted entries.
+    The newest MAX_CHAT_STORED entries are kept and the memory expires a day after the last conversation.
+    Returns user_chats with the new conversation appended.
     example chat:
     [
         {
@@ -112,49 +412,75 @@ def add_user_chat_redis(user_id, input, answer, user_chats:list=[], update=True)
     ]
     """
     print(f"########### Adding memory for user: {user_id}", flush=True)
-    max_chat_stored = 3
     try:
         # Replace newlines and multiple spaces with a single space, then strip trailing spaces
         answer = ' '.join(answer.split())
-        key = f"chat:{user_id}"
-        chats = user_chats
-
-        if not user_chats:
-            chats = get_secure(key)
-            # chats = r.get(key)
-        
-        if chats:
-            if isinstance(chats, str):
-                chats = json.loads(chats)
-            
-            if len(chats) > max_chat_stored:
-                chats.pop(0)
-                print(f"########### Memory limit reached for user: {user_id}. Oldest message removed.", flush=True)
-            chats.append({
-                "userMessage": input,
-                "aiMessage": answer,
-                "timestamp": str(datetime.now(tzn.utc))
-            })
-        else:
-            chats = [{
-                "userMessage": input,
-                "aiMessage": answer,
-                "timestamp": str(datetime.now(tzn.utc))
-            }]
+        key = chat_key(user_id)
+        chat = {
+            "userMessage": input,
+            "aiMessage": answer,
+            "timestamp": str(datetime.now(tzn.utc))
+        }
 
         if update:
-            update_user_memory_redis(key, chats)
+            ADD_CHAT_SCRIPT(keys=[key], args=[encode_secure(key, chat), MAX_CHAT_STORED, CHAT_MEMORY_TTL])
             print(f"✅ Memory updated for user: {user_id}", flush=True)
-        
-        return chats
+
+        return (list(user_chats) + [chat])[-MAX_CHAT_STORED:]
     except Exception as e:
         print(f"❌ Error updating memory for user {user_id}: {e}", flush=True)
         set_sentry_context(user_id, input, answer, f"Error in add_user_chat_redis function: Failed to update memory", e)
         return []
 
+def recent_chats(chats, now=None):
+    """
+    Drop conversations older than CHAT_MEMORY_TTL, entries without a readable timestamp are kept.
+    """
+    cutoff = (now or datetime.now(tzn.utc)) - timedelta(seconds=CHAT_MEMORY_TTL)
+    recent = []
+    for chat in chats:
+        if not isinstance(chat, dict):
+            continue
+        ts = chat.get('timestamp')
+        if isinstance(ts, str):
+            try:
+                ts = datetime.fromisoformat(ts.replace('Z', '+00:00'))
+            except ValueError:
+                ts = None
+        if isinstance(ts, datetime) and ts < cutoff:
+            continue
+        recent.append(chat)
+    return recent
+
+def migrate_user_chat_redis(key):
+    """
+    Convert a memory stored as one JSON string into the list layout. Returns the stored conversations.
+    """
+    chats = get_secure(key)
+    if isinstance(chats, str):
+        chats = json.loads(chats)
+    if not isinstance(chats, list):
+        return []
+
+    update_user_memory_redis(key, chats)
+    print(f"########### Memory migrated to list for key: {key}", flush=True)
+    return chats[-MAX_CHAT_STORED:]
+
+def load_user_chat_redis(key):
+    """
+    Read all stored conversations of a memory key, oldest first, including expired ones.
+    """
+    chats = get_secure_many([key], list_keys=(key,))[0]
+    if isinstance(chats, redis.exceptions.ResponseError):
+        # WRONGTYPE: still a single JSON string
+        return migrate_user_chat_redis(key)
+    if isinstance(chats, Exception):
+        raise chats
+    return chats
+
 def get_user_chat_redis(user_id) -> list:
     """
-    Retrieve a user's memory from Redis.
+    Retrieve a user's conversations of the last day from Redis.
     example chat:
     [
         {
@@ -165,17 +491,7 @@ def get_user_chat_redis(user_id) -> list:
     ]
     """
     try:
-        key = f"chat:{user_id}"
-        memory = get_secure(key)
-        # memory = r.get(key)
-        
-        if memory:
-            if isinstance(memory, str):
-                memory = json.loads(memory)
-
-            return memory
-        else:
-            return []
+        return recent_chats(load_user_chat_redis(chat_key(user_id)))
     except Exception as e:
         print(f"❌ Error retrieving memory for user {user_id}: {e}", flush=True)
         set_sentry_context(user_id, None, None, f"Error in get_user_chat_redis function: Failed to retrieve memory", e)
@@ -183,46 +499,19 @@ def get_user_chat_redis(user_id) -> list:
 
 def delete_user_chat_redis(user_id, chats:list=[], update=True):
     """
-    Delete a user's chat from Redis.
+    Drop a user's conversations older than a day. Returns the remaining conversations.
     """
-    now = datetime.now(tzn.utc)
     try:
-        key = f"chat:{user_id}"
-        user_chats = chats
-        
-        if not chats:
-            user_chats = get_secure(key)
-            # user_chats = r.get(key)
-
-        if user_chats:
-            if isinstance(user_chats, str):
-                user_chats = json.loads(user_chats)
-
-            index_to_remove = []
-            for index, chat in enumerate(user_chats):
-                print(f"Checking chat {index} for user {user_id}: chat: {chat}", flush=True)
-                ts = chat.get('timestamp')
-                if not ts:
-                    continue
-                
-                if isinstance(ts, str):
-                    try:
-                        ts = datetime.fromisoformat(ts.replace('Z', '+00:00'))
-                    except ValueError:
-                        continue
-                
-                # check if this conversation is older than 24 hours
-                if ts < (now - timedelta(hours=24)):
-                    index_to_remove.append(index)
-
-            # Remove chats in reverse order to avoid index shifting
-            for index in reversed(index_to_remove):
-                user_chats.pop(index)
-
-            if update:
-                update_user_memory_redis(key, user_chats)
-            
-            return user_chats
+        key = chat_key(user_id)
+        user_chats = chats or load_user_chat_redis(key)
+        remaining = recent_chats(user_chats)
+
+        expired = len(user_chats) - len(remaining)
+        if update and expired and not chats:
+            # entries are appended in time order, so the expired ones are at the head of the list
+            r.ltrim(key, expired, -1)
+
+        return remaining
     except Exception as e:
         print(f"❌ Error deleting chat memory for user {user_id}: {e}", flush=True)
         set_sentry_context(user_id, None, None, f"Error in delete_user_chat_redis function: Failed to delete chat memory", e)
@@ -230,59 +519,122 @@ def delete_user_chat_redis(user_id, chats:list=[], update=True):
 
 def add_and_delete_user_chat_redis(user_id, input, answer):
     """
-    Add a new conversation to a user's memory and delete old conversations if necessary.
+    Add a new conversation to a user's memory. Old conversations are trimmed by the append and filtered out on read.
     """
     try:
-        chats_after_delete = delete_user_chat_redis(user_id)
-        add_user_chat_redis(user_id, input, answer, chats_after_delete, update=True)
-        print(f"✅ Memory added and old conversations deleted for user: {user_id}", flush=True)
+        add_user_chat_redis(user_id, input, answer, update=True)
     except Exception as e:
         print(f"❌ Error in add_and_delete_user_chat_redis for user {user_id}: {e}", flush=True)
         set_sentry_context(user_id, input, answer, f"Error in add_and_delete_user_chat_redis function: Failed to add and delete user memory", e)
 
 #### Redis Draft Functions ####
 
-def get_latest_draft_redis(user_id) -> dict:
+def write_draft_redis(key, draft):
+    pipe = r.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={field: encode_secure_field(key, value) for field, value in draft.items()})
+    pipe.expire(key, DRAFT_TTL)
+    pipe.execute()
+
+def migrate_draft_redis(key):
     """
-    Retrieve the latest event draft for a user from Redis.
+    Convert a draft stored as one string into a hash. Returns the draft.
+    """
+    draft = get_secure(key)
+    if isinstance(draft, str):
+        draft = json.loads(draft)
+    if not isinstance(draft, dict) or not draft:
+        return {}
+
+    write_draft_redis(key, draft)
+    print(f"########### Draft migrated to hash for key: {key}", flush=True)
+    return draft
+
+def get_draft_fields_redis(user_id, fields=None) -> dict:
+    """
+    Retrieve some fields of a user's event draft, all fields when none are given.
     """
     try:
-        key = f"draft:{user_id}"
-        draft = get_secure(key)
-        # draft = r.get(key)
-        
-        if draft:
-            if isinstance(draft, str):
-                draft = json.loads(draft)
-            return draft
-        else:
-            return {}
+        key = draft_key(user_id)
+        draft = get_secure_many([key], hash_keys={key: fields})[0]
+        if isinstance(draft, redis.exceptions.ResponseError):
+            # WRONGTYPE: still a single string
+            draft = migrate_draft_redis(key)
+            if fields:
+                draft = {field: draft[field] for field in fields if field in draft}
+        elif isinstance(draft, Exception):
+            raise draft
+        return draft or {}
     except Exception as e:
-        print(f"❌ Error retrieving latest draft for user {user_id}: {e}", flush=True)
-        set_sentry_context(user_id, None, None, f"Error in get_latest_draft_redis function: Failed to retrieve latest draft", e)
+        print(f"❌ Error retrieving draft fields for user {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in get_draft_fields_redis function: Failed to retrieve draft fields", e)
         return {}
+
+def get_latest_draft_redis(user_id) -> dict:
+    """
+    Retrieve the latest event draft for a user from Redis.
+    """
+    return get_draft_fields_redis(user_id)
     
 def add_event_draft_redis(user_id, draft:dict):
     """
-    Add or update an event draft for a user in Redis.
+    Add or replace the event draft of a user in Redis, stored as a hash of individually encrypted fields.
     """
     try:
-        key = f"draft:{user_id}"
+        key = draft_key(user_id)
         draft['timestamp'] = str(datetime.now(tzn.utc))
-        add_secure(key, draft, ttl=60*60*24)  # store draft for 24 hours
-        # r.set(key, json.dumps(draft))
+        write_draft_redis(key, draft)  # store draft for 24 hours
         print(f"✅ Draft added/updated for user: {user_id}", flush=True)
         return draft
     except Exception as e:
         print(f"❌ Error adding/updating draft for user {user_id}: {e}", flush=True)
         set_sentry_context(user_id, None, None, f"Error in add_event_draft_redis function: Failed to add/update draft", e)
 
+def update_event_draft_fields_redis(user_id, fields:dict):
+    """
+    Change some fields of the user's event draft, e.g. only the location or the reminder, leaving the others untouched.
+    Returns the fields written, or None when the user has no draft.
+    """
+    try:
+        key = draft_key(user_id)
+        fields = dict(fields, timestamp=str(datetime.now(tzn.utc)))
+        args = [DRAFT_TTL]
+        for field, value in fields.items():
+            args += [field, encode_secure_field(key, value)]
+
+        result = UPDATE_DRAFT_FIELDS_SCRIPT(keys=[key], args=args)
+        if result == -1 and migrate_draft_redis(key):
+            result = UPDATE_DRAFT_FIELDS_SCRIPT(keys=[key], args=args)
+        if result != 1:
+            print(f"ℹ️ No draft to update for user: {user_id}", flush=True)
+            return None
+
+        print(f"✅ Draft fields updated for user: {user_id}: {list(fields)}", flush=True)
+        return fields
+    except Exception as e:
+        print(f"❌ Error updating draft fields for user {user_id}: {e}", flush=True)
+        set_sentry_context(user_id, None, None, f"Error in update_event_draft_fields_redis function: Failed to update draft fields", e)
+
+def save_event_draft_redis(user_id, draft:dict):
+    """
+    Store a new version of the user's event draft. An edit of some fields of the current draft (e.g. only the location)
+    writes just the changed fields; a first draft, or one that drops fields, replaces the hash.
+    """
+    current = get_latest_draft_redis(user_id)
+    if current and set(current) - {'timestamp'} <= set(draft):
+        changed = {field: value for field, value in draft.items() if field != 'timestamp' and current.get(field) != value}
+        updated = update_event_draft_fields_redis(user_id, changed)
+        if updated is not None:
+            draft['timestamp'] = updated['timestamp']
+            return draft
+    return add_event_draft_redis(user_id, draft)
+
 def delete_user_draft_redis(user_id):
     """
     Delete a user's event draft from Redis.
     """
     try:
-        key = f"draft:{user_id}"
+        key = draft_key(user_id)
         r.delete(key)
         print(f"✅ Draft deleted for user: {user_id}", flush=True)
     except Exception as e:
@@ -296,9 +648,20 @@ def get_latest_chat_and_draft_redis(user_id):
     Retrieve the latest chat and event draft for a user from Redis.
     """
     try:
-        chat = get_user_chat_redis(user_id)
-        draft = get_latest_draft_redis(user_id)
-        return chat, draft
+        # both come with every LLM call, fetched together in one round trip
+        chat_generation, draft_generation = get_namespace_generations("chat", "draft")
+        memory_key = namespaced_key("chat", user_id, chat_generation)
+        event_draft_key = namespaced_key("draft", user_id, draft_generation)
+        chat, draft = get_secure_many(
+            [memory_key, event_draft_key],
+            list_keys=(memory_key,),
+            hash_keys={event_draft_key: DRAFT_PROMPT_FIELDS}
+        )
+        if isinstance(chat, Exception):
+            chat = load_user_chat_redis(memory_key)
+        if isinstance(draft, Exception):
+            draft = get_draft_fields_redis(user_id, DRAFT_PROMPT_FIELDS)
+        return recent_chats(chat or []), draft or {}
     except Exception as e:
         print(f"❌ Error retrieving chat and draft for user {user_id}: {e}", flush=True)
         set_sentry_context(user_id, None, None, f"Error in get_latest_chat_and_draft_redis function: Failed to retrieve chat and draft", e)
@@ -306,25 +669,26 @@ def get_latest_chat_and_draft_redis(user_id):
     
 def clear_all_user_memories_redis():
     """
-    Clear all user memories from Redis.
+    Clear all user memories from Redis. The old keys are unlinked in the background by sweep_namespace_redis.
     """
     try:
-        keys = r.keys("chat:*")
-        if keys:
-            r.delete(*keys)
-            print("✅ All user memories cleared", flush=True)
-        else:
-            print("ℹ️ No user memories to clear", flush=True)
+        generation = clear_namespace_redis("chat")
+        print(f"✅ All user memories cleared, chat namespace now at generation {generation}", flush=True)
     except Exception as e:
         print(f"❌ Error clearing all user memories: {e}", flush=True)
         set_sentry_context(None, None, None, f"Error in clear_all_user_memories_redis function: Failed to clear all user memories", e)
     
 def update_user_memory_redis(key, chats):
     """
-    Update a user's chat memory with a new conversation.
+    Replace a user's chat memory with the given conversations.
     """
     try:
-        add_secure(key, chats)
+        pipe = r.pipeline()
+        pipe.delete(key)
+        if chats:
+            pipe.rpush(key, *[encode_secure(key, chat) for chat in chats[-MAX_CHAT_STORED:]])
+            pipe.expire(key, CHAT_MEMORY_TTL)
+        pipe.execute()
     except Exception as e:
         print(f"❌ Error in update_user_memory_redis for key {key}: {e}", flush=True)
-        set_sentry_context(None, None, None, f"Error in update_user_memory_redis function: Failed to update user chat for key {key}", e)
\ No newline at end of file
+        set_sentry_context(None, None, None, f"Error in update_user_memory_redis function: Failed to update user chat for key {key}", e)
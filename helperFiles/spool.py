@@ -0,0 +1,123 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from helperFiles.sentry_helper import set_sentry_context
+from helperFiles.job_serializer import CompactSerializer
+
+SPOOL_PATH = os.environ.get("ENQUEUE_SPOOL_PATH", "enqueue_spool.db")
+SPOOL_REPLAY_INTERVAL = int(os.environ.get("ENQUEUE_SPOOL_REPLAY_INTERVAL", 5))  # seconds between replay attempts
+SPOOL_REPLAY_BATCH = 100
+SPOOL_REPLAYED_TTL = 60*60*24*7  # replayed job ids are remembered this long, finished jobs may be deleted right away (result_ttl 0)
+
+replayer_thread = None
+replayer_lock = threading.Lock()
+
+def connect_spool():
+    connection = sqlite3.connect(SPOOL_PATH, timeout=10, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")  # gunicorn workers share the file
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS spooled_jobs ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT UNIQUE, queue_name TEXT, func_path TEXT, payload BLOB, created_at REAL)"
+    )
+    return connection
+
+def spool_job(queue_name, func, args, kwargs):
+    """
+    Append a job that could not be enqueued to the local spool, the replayer pushes it to RQ once redis is back.
+    The job id doubles as dedupe key, so a job is never queued twice by the replayer.
+    """
+    job_id = kwargs.pop("job_id", None) or f"spooled-{uuid.uuid4().hex}"
+    connection = connect_spool()
+    try:
+        connection.execute(
+            "INSERT OR IGNORE INTO spooled_jobs (job_id, queue_name, func_path, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+            (job_id, queue_name, f"{func.__module__}.{func.__name__}", CompactSerializer.dumps([args, kwargs]), time.time())
+        )
+    finally:
+        connection.close()
+
+    print(f"########### Spooled {func.__name__} for {queue_name} queue as {job_id}", flush=True)
+    ensure_replayer_started()
+    return job_id
+
+def get_spool_size():
+    try:
+        connection = connect_spool()
+        try:
+            return connection.execute("SELECT COUNT(*) FROM spooled_jobs").fetchone()[0]
+        finally:
+            connection.close()
+    except Exception as e:
+        print(f"❌ Error reading spool size: {e}", flush=True)
+        return None
+
+def replay_spool():
+    """
+    Push spooled jobs to RQ in order. Returns how many were replayed.
+    """
+    from rq.job import Job
+    from helperFiles.queue_helper import queues, q
+    from helperFiles.redis_helper import r_worker
+
+    replayed = 0
+    connection = connect_spool()
+    try:
+        while True:
+            # the write lock keeps the replayers of other processes from pushing the same rows
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(
+                "SELECT id, job_id, queue_name, func_path, payload FROM spooled_jobs ORDER BY id LIMIT ?", (SPOOL_REPLAY_BATCH,)
+            ).fetchall()
+            if not rows:
+                connection.execute("COMMIT")
+                break
+
+            try:
+                for row_id, job_id, queue_name, func_path, payload in rows:
+                    # already queued by an earlier replay that crashed before deleting the row, and maybe already run
+                    replayed_key = f"spool_replayed:{job_id}"
+                    if not r_worker.exists(replayed_key) and not Job.exists(job_id, connection=r_worker):
+                        args, kwargs = CompactSerializer.loads(payload)
+                        pipe = r_worker.pipeline()
+                        queues.get(queue_name, q).enqueue(func_path, *args, job_id=job_id, pipeline=pipe, **kwargs)
+                        pipe.set(replayed_key, 1, ex=SPOOL_REPLAYED_TTL)
+                        pipe.execute()  # the job and its marker are written together
+                    connection.execute("DELETE FROM spooled_jobs WHERE id = ?", (row_id,))
+                    replayed += 1
+                connection.execute("COMMIT")
+            except Exception:
+                # keep the rows replayed so far, retry the rest later
+                connection.execute("COMMIT")
+                raise
+    finally:
+        connection.close()
+
+    if replayed:
+        print(f"########### Replayed {replayed} spooled jobs", flush=True)
+    return replayed
+
+def run_replayer():
+    while True:
+        time.sleep(SPOOL_REPLAY_INTERVAL)
+        try:
+            if get_spool_size():
+                replay_spool()
+        except Exception as e:
+            print(f"########### Spool replay failed, retrying in {SPOOL_REPLAY_INTERVAL}s: {e}", flush=True)
+
+def ensure_replayer_started():
+    global replayer_thread
+    with replayer_lock:
+        if replayer_thread is None or not replayer_thread.is_alive():
+            replayer_thread = threading.Thread(target=run_replayer, name="enqueue-spool-replayer", daemon=True)
+            replayer_thread.start()
+
+# pick up jobs left in the spool by a previous process
+if os.path.exists(SPOOL_PATH):
+    try:
+        if get_spool_size():
+            ensure_replayer_started()
+    except Exception as e:
+        set_sentry_context(None, None, None, f"Error checking enqueue spool at startup", e)
@@ -100,6 +100,7 @@ def init_llm_assistant(user_id, input, today, service, twilio_number, image_data
         # Parse voice input
         if voice_data_filename:
             input = parse_voice(voice_data_filename, client)
+            voice_data_filename = None  # the follow-up LLM calls reuse the transcript
 
         check_input_not_none(input, image_data_url)
 
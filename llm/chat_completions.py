@@ -1,4 +1,4 @@
-from services.model import init_openai, init_params, init_llm
+from services.model import init_openai, init_params, init_llm, transcribe_voice
 from variables.toolbox import tools
 from datetime import datetime, timedelta, timezone as tzn
 from helperFiles.helpers import clean_instruction_block, send_whatsapp_message, parse_llm_answer
@@ -21,6 +21,11 @@ def invoke_model(resp, user_id, input, is_test=False, image_data_url=None, voice
     service = params['service']
     user_timezone = params['user_timezone']
 
+    if voice_data_filename:
+        # transcribed once here, the follow-up LLM calls below reuse the text
+        input = transcribe_voice(voice_data_filename)
+        voice_data_filename = None
+
     raw_answer = init_llm(user_id, input, prompt_type, image_data_url, user_timezone, voice_data_filename, None)
     answer = clean_instruction_block(raw_answer)
     whatsappNum = f'whatsapp:+{user_id}'
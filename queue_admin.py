@@ -0,0 +1,87 @@
+import argparse
+from datetime import timezone as tzn
+from rq.job import Job
+from helperFiles.redis_helper import r_worker
+from helperFiles.queue_helper import QUEUE_NAMES, LEGACY_QUEUE_NAME, queues, q
+from helperFiles.job_serializer import CompactSerializer
+
+FETCH_BATCH_SIZE = 200
+
+def get_queues(queue_name=None):
+    all_queues = dict(queues, **{LEGACY_QUEUE_NAME: q})
+    if queue_name:
+        return [all_queues[queue_name]]
+    return list(all_queues.values())
+
+def iter_failed_jobs(queue, func_name=None):
+    """
+    Yield the failed jobs of a queue, oldest first, optionally only those of one job type.
+    """
+    job_ids = queue.failed_job_registry.get_job_ids()
+    for start in range(0, len(job_ids), FETCH_BATCH_SIZE):
+        jobs = Job.fetch_many(job_ids[start:start + FETCH_BATCH_SIZE], connection=r_worker, serializer=CompactSerializer)
+        for job in jobs:
+            if job is None:
+                continue # expired between listing and fetching
+            if func_name and job.func_name.rsplit(".", 1)[-1] != func_name:
+                continue
+            yield job
+
+def last_error_line(job):
+    result = job.latest_result()
+    exc_string = getattr(result, "exc_string", None) or ""
+    lines = exc_string.strip().splitlines()
+    return lines[-1] if lines else ""
+
+def list_failed(queue_name=None, func_name=None, limit=50):
+    for queue in get_queues(queue_name):
+        count = 0
+        for job in iter_failed_jobs(queue, func_name):
+            if count < limit:
+                ended_at = job.ended_at.replace(tzinfo=tzn.utc).isoformat() if job.ended_at else "-"
+                print(f"{queue.name}\t{job.id}\t{job.func_name}\t{ended_at}\t{last_error_line(job)}")
+            count += 1
+        print(f"########### {queue.name}: {count} failed jobs{f' ({count - limit} not shown)' if count > limit else ''}", flush=True)
+
+def requeue_failed(queue_name=None, func_name=None, job_ids=None, dry_run=False):
+    """
+    Put failed jobs back at the end of their queue, all of them or only the given ids. Returns how many were requeued.
+    """
+    requeued = 0
+    for queue in get_queues(queue_name):
+        registry = queue.failed_job_registry
+        if job_ids:
+            failed_ids = set(registry.get_job_ids())
+            targets = [job_id for job_id in job_ids if job_id in failed_ids]
+        else:
+            targets = [job.id for job in iter_failed_jobs(queue, func_name)]
+
+        for job_id in targets:
+            if dry_run:
+                print(f"Would requeue {job_id} on {queue.name}")
+            else:
+                registry.requeue(job_id)
+            requeued += 1
+        if targets:
+            print(f"########### {queue.name}: {'would requeue' if dry_run else 'requeued'} {len(targets)} jobs", flush=True)
+    return requeued
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and requeue failed Kalenda RQ jobs.")
+    parser.add_argument("--queue", choices=QUEUE_NAMES + [LEGACY_QUEUE_NAME], help="only this queue (default: all queues)")
+    parser.add_argument("--func", help="only jobs of this type, e.g. deduct_chat_balance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="list failed jobs with their last error")
+    list_parser.add_argument("--limit", type=int, default=50, help="jobs shown per queue (default: 50)")
+
+    requeue_parser = commands.add_parser("requeue", help="requeue failed jobs")
+    requeue_parser.add_argument("job_ids", nargs="*", help="job ids to requeue (default: every failed job matching --queue and --func)")
+    requeue_parser.add_argument("--dry-run", action="store_true", help="only print what would be requeued")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        list_failed(args.queue, args.func, args.limit)
+    else:
+        total = requeue_failed(args.queue, args.func, args.job_ids, args.dry_run)
+        print(f"########### {'Would requeue' if args.dry_run else 'Requeued'} {total} jobs in total", flush=True)
@@ -12,7 +12,11 @@ import os.path
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+import google_auth_httplib2
+import httplib2
+import threading
 from datetime import datetime, timedelta, timezone as tzn
 import json
 from cryptography.fernet import Fernet
@@ -23,11 +27,32 @@ from requests.auth import HTTPBasicAuth
 import re
 from authorization.creds import *
 from services.database import user_collection, tokens_collection, add_update_timezone
-from authorization.auth import decrypt_token, encrypt_token, save_token
+from authorization.auth import save_token
+from authorization import encryption
 from helperFiles.helpers import readable_date, convert_timezone, all_valid_emails, extract_json_block, init_llm_helper, format_event_datetime
 from helperFiles.session_memory import latest_event_draft, get_user_memory, session_memories
 from prompts.prompt_full import prompt_calendar_finder
-from helperFiles.redis_helper import get_user_chat_redis, add_event_draft_redis, delete_user_draft_redis
+from helperFiles.redis_helper import get_user_chat_redis, save_event_draft_redis, delete_user_draft_redis
+
+calendar_discovery_doc = None
+google_http = threading.local()
+
+def get_calendar_discovery_doc():
+    """
+    Load the bundled calendar discovery document once per process instead of on every service build.
+    """
+    global calendar_discovery_doc
+    if calendar_discovery_doc is None:
+        calendar_discovery_doc = get_static_doc('calendar', 'v3')
+    return calendar_discovery_doc
+
+def get_google_http(creds):
+    """
+    Authorized transport that reuses this thread's HTTP connection to Google across calls.
+    """
+    if not hasattr(google_http, "http"):
+        google_http.http = httplib2.Http(timeout=60)
+    return google_auth_httplib2.AuthorizedHttp(creds, http=google_http.http)
 
 def get_calendar_service(user_id, is_test=False):
     try:        
@@ -61,8 +86,8 @@ def get_calendar_service(user_id, is_test=False):
             is_token_expired = True
 
         creds = Credentials(
-            token=decrypt_token(access_token),
-            refresh_token=decrypt_token(refresh_token),
+            token=encryption.decrypt(access_token),
+            refresh_token=encryption.decrypt(refresh_token),
             token_uri=TOKEN_URI,
             client_id=client_id,
             client_secret=client_secret,
@@ -77,7 +102,7 @@ def get_calendar_service(user_id, is_test=False):
                 creds.refresh(Request())
                 
                 # Store the updated token info
-                updated_token = encrypt_token(creds.token)
+                updated_token = encryption.encrypt(creds.token)
                 updated_expiry = creds.expiry.isoformat()
                 
                 if is_using_test_account:
@@ -106,7 +131,11 @@ def get_calendar_service(user_id, is_test=False):
                     return "token_revoked"
                 raise
             
-        service = build('calendar', 'v3', credentials=creds)
+        discovery_doc = get_calendar_discovery_doc()
+        if discovery_doc:
+            service = build_from_document(discovery_doc, http=get_google_http(creds))
+        else:
+            service = build('calendar', 'v3', credentials=creds)
         print("########### Calendar service initialized {service}", flush=True)
         return service
     except Exception as e:
@@ -302,7 +331,7 @@ def update_event_draft(user_id, new_draft, status='draft'):
     new_draft['status'] = status
 
     try:
-        add_event_draft_redis(user_id, new_draft)
+        save_event_draft_redis(user_id, new_draft)
         print(f"########### New draft saved to redis for user: {user_id} {new_draft}", flush=True)
         return new_draft
     except Exception as e:
@@ -435,7 +464,6 @@ def save_event_to_calendar(instruction, user_id, is_test=False, service=None):
         json_str = extract_json_block(json_str_raw)
         print(f"####### JSON string: {json_str}")
         event_details = json.loads(json_str)
-        update_event_draft(user_id, event_details)
     except Exception as e:
         print(f"####### Failed to parse event JSON: {e}")
         return "Sorry, I couldn't understand your event details."
@@ -468,6 +496,7 @@ def save_event_to_calendar(instruction, user_id, is_test=False, service=None):
                 break
         if not calendar_id:
             print(f"########### Calendar '{calendar_name}' not found.")
+            update_event_draft(user_id, event_details) # keep the event so the user can pick another calendar
             return "Sorry, I can not find the specific calendar name you're referring to."
         
     attendees = []
@@ -509,6 +538,7 @@ def save_event_to_calendar(instruction, user_id, is_test=False, service=None):
         event['recurrence'] = recurrence
 
     print(f"########### FINAL event details: {event}", flush=True)
+    new_event = None
     try:
         if sendUpdates == 'all':
             new_event = service.events().insert(calendarId=calendar_id, body=event, sendUpdates=sendUpdates).execute()
@@ -540,6 +570,8 @@ def save_event_to_calendar(instruction, user_id, is_test=False, service=None):
         return f"{summary}"
     except Exception as e:
         print(f"########### Error adding to g-cal: {e}")
+        if not new_event:
+            update_event_draft(user_id, event_details) # the event was not created, keep it as the draft to retry
         return None
     
 def update_timezone(answer, user_id, is_test=False):
@@ -1,11 +1,23 @@
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+import os
+import json
 from authorization.creds import *
 from datetime import datetime, timedelta, timezone as tzn
 from helperFiles.helpers import send_error_whatsapp_message, send_whatsapp_message
 from variables.text import using_test_calendar, using_test_calendar_whitelist
 from helperFiles.session_memory import get_user_memory
-from helperFiles.redis_helper import get_latest_chat_and_draft_redis
+from helperFiles.redis_helper import r, get_latest_chat_and_draft_redis
 from helperFiles.sentry_helper import set_sentry_context
+from helperFiles.queue_helper import safe_enqueue, safe_enqueue_in
+from helperFiles.profile_cache import get_cached_profile, invalidate_profile
+
+DAILY_CHAT_LIMIT = 10
+
+ANALYTICS_BUFFER_KEY = "analytics:interactions"
+ANALYTICS_FLUSH_SCHEDULED_KEY = "analytics:flush_scheduled"
+ANALYTICS_BATCH_SIZE = int(os.environ.get("ANALYTICS_BATCH_SIZE", 100))         # flush as soon as this many records are buffered
+ANALYTICS_FLUSH_INTERVAL = int(os.environ.get("ANALYTICS_FLUSH_INTERVAL", 60))  # otherwise flush at most this many seconds after the first record
 
 def init_mongodb():
     try:
@@ -47,22 +59,25 @@ else:
     thread_collections = None
     analytics_collection = None
 
+def build_interaction(input, answer, user_id, type="unknown"):
+    # change input and answer to character count
+    input_count = len(input)
+    answer_count = len(answer)
+    return {
+        "key": "interactions",
+        "user_id": user_id,
+        "type": type,
+        "input_char_count": input_count,
+        "answer_char_count": answer_count,
+        "total_char_count": input_count + answer_count,
+        "timestamp": datetime.now(tzn.utc)
+    }
+
 def add_interaction(input, answer, user_id, type="unknown"):
     print(f"########### Adding interaction: {input}, {answer}, {user_id}, type: {type}", flush=True)
     try:
         # Record interaction data with generated id
-        # change input and answer to character count
-        input_count = len(input)
-        answer_count = len(answer)
-        interaction_id = analytics_collection.insert_one({
-            "key": "interactions",
-            "user_id": user_id,
-            "type": type,
-            "input_char_count": input_count,
-            "answer_char_count": answer_count,
-            "total_char_count": input_count + answer_count,
-            "timestamp": datetime.now(tzn.utc)
-        }).inserted_id
+        interaction_id = analytics_collection.insert_one(build_interaction(input, answer, user_id, type)).inserted_id
         print(f"########### Interaction added: {interaction_id}", flush=True)
         return True
     except Exception as e:
@@ -70,6 +85,68 @@ def add_interaction(input, answer, user_id, type="unknown"):
         set_sentry_context(user_id=user_id, input=None, answer=None, message="add_interaction error", error=str(e))
         return False
 
+def record_interaction(input, answer, user_id, type="unknown"):
+    """
+    Buffer an interaction record in redis, flush_interactions writes the buffered records to mongo in batches.
+    Falls back to a single add_interaction job when redis is unavailable.
+    """
+    try:
+        interaction = build_interaction(input, answer, user_id, type)
+        interaction["timestamp"] = interaction["timestamp"].isoformat()
+        buffered = r.rpush(ANALYTICS_BUFFER_KEY, json.dumps(interaction))
+
+        if buffered % ANALYTICS_BATCH_SIZE == 0:
+            safe_enqueue(flush_interactions)
+        elif r.set(ANALYTICS_FLUSH_SCHEDULED_KEY, 1, nx=True, ex=ANALYTICS_FLUSH_INTERVAL * 2):
+            # first record since the last flush: make sure it is written within the flush interval
+            safe_enqueue_in(ANALYTICS_FLUSH_INTERVAL, flush_interactions)
+        return True
+    except Exception as e:
+        print(f"Error buffering interaction, adding it directly: {e}", flush=True)
+        set_sentry_context(user_id=user_id, input=None, answer=None, message="record_interaction error", error=str(e))
+        safe_enqueue(add_interaction, input, answer, user_id, type)
+        return False
+
+def flush_interactions():
+    """
+    Write all buffered interaction records to mongo with unordered insert_many batches.
+    """
+    flushed = 0
+    try:
+        while True:
+            pipe = r.pipeline()
+            pipe.lrange(ANALYTICS_BUFFER_KEY, 0, ANALYTICS_BATCH_SIZE - 1)
+            pipe.ltrim(ANALYTICS_BUFFER_KEY, ANALYTICS_BATCH_SIZE, -1)
+            items, _ = pipe.execute()
+            if not items:
+                break
+
+            interactions = [json.loads(item) for item in items]
+            for interaction in interactions:
+                interaction["timestamp"] = datetime.fromisoformat(interaction["timestamp"])
+
+            try:
+                analytics_collection.insert_many(interactions, ordered=False)
+                flushed += len(interactions)
+            except BulkWriteError as e:
+                # unordered insert: everything except the reported errors was written
+                flushed += e.details.get("nInserted", 0)
+                print(f"Error in some interactions of the batch: {e.details.get('writeErrors')}", flush=True)
+                set_sentry_context(user_id=None, input=None, answer=None, message="flush_interactions partial write error", error=str(e))
+            except Exception:
+                # nothing was written, give the records back for the next flush
+                r.rpush(ANALYTICS_BUFFER_KEY, *items)
+                raise
+
+        print(f"########### Interactions flushed: {flushed}", flush=True)
+        return flushed
+    except Exception as e:
+        print(f"Error flushing interactions: {e}", flush=True)
+        set_sentry_context(user_id=None, input=None, answer=None, message="flush_interactions error", error=str(e))
+        return flushed
+    finally:
+        r.delete(ANALYTICS_FLUSH_SCHEDULED_KEY)
+
 def get_interactions(type="unknown"):
     try:
         # Find all interactions of a specific type
@@ -137,8 +214,8 @@ def add_likes(ipaddr=None):
 
 def check_user(user_id):
     print(f"########### Checking user: {user_id}", flush=True)
-    daily_limit = 10
-    user = user_collection.find_one({"user_id": user_id})
+    daily_limit = DAILY_CHAT_LIMIT
+    user = get_user_profile(user_id)
     if user:
         balance = user.get("chat_balance", daily_limit)
         userType = user.get("type", 'regular')
@@ -167,6 +244,7 @@ def check_user(user_id):
                     "last_balance_reset": datetime.now(tzn.utc)
                 }}
             )
+            invalidate_profile(user_id)
 
         return {"status": "existing", "user_id": user_id, "chat_balance": balance, "type": userType, "user_details": user, "is_using_test_account": is_using_test_account}
     else:
@@ -179,32 +257,43 @@ def check_user(user_id):
             "is_using_test_account": True,
             "last_balance_reset": current_time
         })
+        invalidate_profile(user_id)
         print(f'########## creating new user: {user_id}, balance: {daily_limit}')
         set_sentry_context(user_id=user_id, input=None, answer=None, message="New User Added", error=None)
         return {"status": "new", "user_id": user_id, "user_details": user, "chat_balance": daily_limit, "type": "regular", "is_using_test_account": True}
 
-def deduct_chat_balance(user, user_id):
+def deduct_chat_balance(user_id, legacy_user_id=None):
+    """
+    Take one chat from the balance of a regular user, in a single filtered update so concurrent jobs cannot go below zero.
+    Jobs queued by older releases still pass (user document, user_id).
+    """
+    if legacy_user_id is not None:
+        user_id = legacy_user_id
     try:
-        if user:
-            print(f'########## deduct_chat_balance: {user}, type: {user["type"]}, balance: {user["chat_balance"]}')
-            if user["type"] == 'regular' and user["chat_balance"] > 0:
-                user_collection.update_one(
-                    {"user_id": user_id},
-                    {
-                        "$inc": {"chat_balance": -1},
-                        "$set": {"last_chat": datetime.now(tzn.utc)}
-                    }
-                )
-                print(f"########### Balance deducted", flush=True)
-                return True
-        else:
-            print(f"########### User not found: {user_id}", flush=True)
-            return False
+        result = user_collection.update_one(
+            {"user_id": user_id, "type": {"$in": ["regular", None]}, "chat_balance": {"$gt": 0}},
+            {
+                "$inc": {"chat_balance": -1},
+                "$set": {"last_chat": datetime.now(tzn.utc)}
+            }
+        )
+        if result.modified_count:
+            invalidate_profile(user_id)
+            print(f"########### Balance deducted: {user_id}", flush=True)
+            return True
+        print(f"########### No balance deducted: {user_id}", flush=True)
+        return False
     except Exception as e:
         print(f"####### Error deducting chat balance: {str(e)}")
         set_sentry_context(user_id=user_id, input=None, answer=None, message="deduct_chat_balance error", error=str(e))
         return False
 
+def get_user_profile(user_id):
+    """
+    User document from the profile cache, read from mongo on a miss. Every write to user_collection must call invalidate_profile.
+    """
+    return get_cached_profile(user_id, lambda: user_collection.find_one({"user_id": user_id}))
+
 def check_user_balance(user):
     if user:
         balance = user["chat_balance"]
@@ -221,7 +310,7 @@ def check_user_balance(user):
     
 def check_timezone(user_id, cal_timezone=None):
     print(f"########### Checking timezone for user: {user_id}", flush=True)
-    user = user_collection.find_one({"user_id": user_id})
+    user = get_user_profile(user_id)
     
     if user:
         is_using_test_account = user.get("is_using_test_account", False)
@@ -247,6 +336,7 @@ def add_update_timezone(user_id, timezone):
                 },
                 upsert=True
             )
+        invalidate_profile(user_id)
         return True
     except Exception as e:
         print(f"Error updating timezone for user {user_id}: {e}", flush=True)
@@ -280,10 +370,11 @@ def use_test_account(user_id):
             "is_using_test_account": True
         }},
     upsert=True)
+    invalidate_profile(user_id)
 
 def check_user_active_email(user_id, user_email=None):
     print(f"########### Checking if user is whitelisted: {user_id}", flush=True)
-    user = user_collection.find_one({"user_id": user_id})
+    user = get_user_profile(user_id)
     print(f"########### User: {user}", flush=True)
 
     if user:
@@ -327,6 +418,7 @@ def add_user_whitelist_status(user_id, email):
             {"$set": {"email": email, "is_email_whitelisted": "Pending"}},
             upsert=True
         )
+        invalidate_profile(user_id)
         return True
     except Exception as e:
         print(f"Error updating whitelist status for {email}: {e}", flush=True)
@@ -348,6 +440,7 @@ def update_user_whitelist_status(email, status):
         )
         user = user_collection.find_one({"email": email})
         user_number = user.get("user_id")
+        invalidate_profile(user_number)
         return user_number
     except Exception as e:
         print(f"Error updating whitelist status for {email}: {e}", flush=True)
@@ -360,6 +453,7 @@ def update_send_whitelisted_message_status(user_number):
         {"$set": {"whitelisted_message_sent": True}},
         upsert=True
     )
+    invalidate_profile(user_number)
     return user_number
 
 def send_test_calendar_message(resp, using_test_calendar, user_id):
@@ -370,6 +464,7 @@ def send_test_calendar_message(resp, using_test_calendar, user_id):
         {"$set": {"test_calendar_message": True}},
         upsert=True
     )
+    invalidate_profile(user_id)
 
 def update_is_using_test_account(user_id):
     user_collection.update_one(
@@ -381,9 +476,10 @@ def update_is_using_test_account(user_id):
             "is_using_test_account": True
         }}
     )
+    invalidate_profile(user_id)
 
 def update_send_test_calendar_message(resp, using_test_calendar, user_id):
-    user = user_collection.find_one({"user_id": user_id})
+    user = get_user_profile(user_id)
     test_calendar_message = user.get("test_calendar_message", False)
 
     if not user or not test_calendar_message:
@@ -403,12 +499,13 @@ def update_send_test_calendar_message(resp, using_test_calendar, user_id):
             # allow to send again
             print("########## resending test calendar message")
             user_collection.update_one({"user_id": user_id}, {"$set": {"test_calendar_message": False}})
+            invalidate_profile(user_id)
             return False
 
     return test_calendar_message
 
 def revoke_access_command(resp, user_id):
-    user_email = user_collection.find_one({"user_id": user_id}).get("email", None)
+    user_email = get_user_profile(user_id).get("email", None)
     if (user_email):
         email_collection.delete_one(
             {"email": user_email})
@@ -425,6 +522,7 @@ def revoke_access_command(resp, user_id):
             "email": ""
         }}
     )
+    invalidate_profile(user_id)
 
     tokens_collection.delete_one(
         {"user_id": user_id}
@@ -24,15 +24,21 @@ from services.calendar_service import get_user_calendar_timezone, get_calendar_s
 from helperFiles.session_memory import get_latest_memory
 from prompts.prompt_full import prompt_init, prompt_analyzer, prompt_finder, prompt_refactored
 from helperFiles.redis_helper import get_latest_chat_and_draft_redis
+from helperFiles.media_store import is_media_handle, get_media_data_url
 
 if mode == 'test':
     os.environ["SSL_CERT_FILE"] = os.environ.get("SSL_CERT_FILE")
 
+openai_client = None  # reused across requests and warm worker jobs
+
 def init_openai():
+    global openai_client
+    if openai_client:
+        return openai_client
     try:
-        client = OpenAI()
+        openai_client = OpenAI()
         print("✅ OpenAI client initialized", flush=True)
-        return client
+        return openai_client
     except Exception as e:
         print(f"❌ Error initializing OpenAI client: {e}", flush=True)
         set_sentry_context(None, None, None, f"Error in init_openai function: OpenAI client initialization failed", e)
@@ -53,6 +59,15 @@ def init_params(user_id, is_test=False, twilio_number=TWILIO_PHONE_NUMBER):
 
     return {"service": service, "now_utc": now_utc, "user_timezone": user_timezone, "error": None}
 
+def transcribe_voice(voice_data_filename):
+    """
+    Transcript of a voice note, for callers making several LLM calls for one message so it is transcribed only once.
+    """
+    client = init_openai()
+    if not client:
+        return None
+    return parse_voice(voice_data_filename, client)
+
 def init_llm(user_id, input, prompt_type, image_data_url=None, user_timezone=None, voice_data_filename=None, other_files=None):
     print(f"############ Initialized with {mode} mode", flush=True)
     try:
@@ -101,9 +116,11 @@ def init_llm(user_id, input, prompt_type, image_data_url=None, user_timezone=Non
         
         if image_data_url:
             set_sentry_context(user_id, image_data_url, None, f"Entering LLM with Image data URL", None)
+            # the pipeline only carries the media handle, the base64 data URL is built here
+            image_url = get_media_data_url(image_data_url) if is_media_handle(image_data_url) else image_data_url
             messages[0]['content'].append({
                 "type": "image_url",
-                "image_url": {"url": image_data_url}
+                "image_url": {"url": image_url}
         })
             
         llm = client.chat.completions.create(
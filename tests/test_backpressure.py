@@ -0,0 +1,46 @@
+import threading
+import pytest
+from helperFiles import backpressure, flush_scheduler
+
+class FakeMetrics:
+    def hincrby(self, *args):
+        pass
+
+@pytest.fixture
+def loaded_executor(monkeypatch):
+    """
+    Every flush thread busy with a pipeline and more flushes waiting behind them, as during a burst in the default mode.
+    """
+    monkeypatch.setattr(backpressure, "r", FakeMetrics())
+    monkeypatch.setattr(backpressure, "get_queue_depth", lambda: 0)  # no RQ queue without FAST_ACK_MODE
+    release = threading.Event()
+    started = threading.Semaphore(0)
+
+    def pipeline():
+        backpressure.pipeline_started()
+        started.release()
+        try:
+            release.wait(10)
+        finally:
+            backpressure.pipeline_finished()
+
+    futures = [flush_scheduler._executor.submit(pipeline) for _ in range(backpressure.SHED_INFLIGHT)]
+    for _ in range(flush_scheduler.FLUSH_MAX_WORKERS):
+        started.acquire(timeout=5)
+    yield
+    release.set()
+    for future in futures:
+        future.result(timeout=10)
+
+def test_idle_process_admits_everyone(monkeypatch):
+    monkeypatch.setattr(backpressure, "r", FakeMetrics())
+    monkeypatch.setattr(backpressure, "get_queue_depth", lambda: 0)
+    assert not backpressure.should_shed({"type": "regular"}, is_test=False)
+    assert not backpressure.should_shed({"type": "regular"}, is_test=True)
+
+def test_flush_backlog_sheds_regular_users(loaded_executor):
+    assert flush_scheduler.flush_backlog() == backpressure.SHED_INFLIGHT - flush_scheduler.FLUSH_MAX_WORKERS
+    assert backpressure.current_load() >= backpressure.SHED_THRESHOLDS["regular"]
+    assert backpressure.should_shed({"type": "regular"}, is_test=False)
+    assert backpressure.should_shed({"type": "regular"}, is_test=True)
+    assert not backpressure.should_shed({"type": "unlimited"}, is_test=False)
@@ -0,0 +1,43 @@
+import fakeredis
+import pytest
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from authorization import encryption
+from helperFiles import redis_helper
+
+@pytest.fixture
+def draft_store(monkeypatch):
+    """
+    Drafts in a fake redis, encrypted with AES-GCM so a rewritten field always gets a new ciphertext.
+    """
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_helper, "r", fake)
+    monkeypatch.setattr(redis_helper, "UPDATE_DRAFT_FIELDS_SCRIPT", fake.register_script(redis_helper.UPDATE_DRAFT_FIELDS_SCRIPT.script))
+    monkeypatch.setattr(redis_helper, "namespace_generations_cache", {})
+    monkeypatch.setattr(redis_helper, "is_not_user_admin", lambda key: True)
+    monkeypatch.setattr(encryption, "ciphers", {1: AESGCM(AESGCM.generate_key(bit_length=256))})
+    monkeypatch.setattr(encryption, "active_version", 1)
+    return fake
+
+def test_edit_rewrites_only_changed_fields(draft_store):
+    user_id = "6281234"
+    draft = {"title": "Dinner", "start": "2026-10-20T19:00:00", "location": "Home", "status": "draft"}
+    redis_helper.save_event_draft_redis(user_id, dict(draft))
+    key = redis_helper.draft_key(user_id)
+    before = draft_store.hgetall(key)
+
+    redis_helper.save_event_draft_redis(user_id, dict(draft, location="Office"))
+    after = draft_store.hgetall(key)
+
+    for field in ("title", "start", "status"):
+        assert after[field] == before[field]  # same ciphertext: the field was not written again
+    assert after["location"] != before["location"]
+    assert redis_helper.get_latest_draft_redis(user_id)["location"] == "Office"
+
+def test_draft_dropping_fields_replaces_the_hash(draft_store):
+    user_id = "6281235"
+    redis_helper.save_event_draft_redis(user_id, {"title": "Dinner", "location": "Home"})
+    redis_helper.save_event_draft_redis(user_id, {"title": "Lunch"})
+
+    stored = redis_helper.get_latest_draft_redis(user_id)
+    assert stored["title"] == "Lunch"
+    assert "location" not in stored
@@ -40,6 +40,23 @@ using_test_calendar_whitelist = (
     "📅 https://calendar.google.com/calendar/embed?src=kalenda.bot%40gmail.com \n\n"
 )
 
+daily_limit_reached = (
+    "⏳ You have reached your daily chat limit. Your balance will be restored tomorrow (GMT+7).\n\n"
+    "Need more? Reach out to admin at kalenda.bot@gmail.com\n\n"
+)
+
+system_busy = (
+    "🚦 Kalenda is very busy right now. Please try again in a few minutes.\n\n"
+)
+
+buffer_full = (
+    "✋ I am still working through your previous messages. Please send this one again after my reply.\n\n"
+)
+
+buffer_media_dropped = (
+    "🖼️ You sent more images than I can read at once, so I skipped the earliest ones. Send them again after my reply if you need them.\n\n"
+)
+
 def connect_to_calendar(auth_link, email):
     return (
         "🔐 Click to connect your Google Calendar:\n"
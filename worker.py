@@ -1,6 +1,149 @@
-from helperFiles.redis_helper import r_worker
-from rq import Worker, Queue
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from helperFiles.redis_helper import r_worker, make_worker_connection
+from helperFiles.queue_helper import QUEUE_NAMES, LEGACY_QUEUE_NAME
+from helperFiles.job_serializer import CompactSerializer
+from services.database import flush_interactions
+from rq import Worker, SimpleWorker, Queue
+import sentry_sdk
+
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 1))
+WORKER_MODE = os.environ.get("WORKER_MODE", "fork")  # "fork": fresh process per job (RQ default), "warm": jobs run in the long-lived worker process
+WORKER_REPORT_INTERVAL = int(os.environ.get("WORKER_REPORT_INTERVAL", 60))  # seconds between job count reports
+WORKER_SHUTDOWN_GRACE = int(os.environ.get("WORKER_SHUTDOWN_GRACE", 60))    # seconds children get to finish their current job
+RESTART_BACKOFF_MAX = 30
+
+def worker_name(index, pid):
+    return f"kalenda-{socket.gethostname()}-{index}-{pid}"
+
+class WarmWorker(SimpleWorker):
+    """
+    Runs jobs inside the worker process so clients opened at boot are reused by every job.
+    A failing job is still only marked failed; each job gets its own sentry scope so user context does not leak into the next one.
+    """
+    def execute_job(self, job, queue):
+        new_scope = getattr(sentry_sdk, "isolation_scope", None) or sentry_sdk.push_scope
+        with new_scope():
+            return super().execute_job(job, queue)
+
+def warm_up():
+    """
+    Open the mongo, redis, OpenAI, Twilio and Google transports once, before the first job arrives.
+    """
+    from services.database import client
+    from services.model import init_openai
+    from services.calendar_service import get_calendar_discovery_doc
+    from helperFiles.helpers import get_twilio_client
+    from helperFiles.redis_helper import r
+    import helperFiles.app_helper  # imports the whole LLM pipeline
+
+    started = time.monotonic()
+    r.ping()
+    r_worker.ping()
+    if isinstance(client, str):
+        print(f"########### Warm up without database: {client}", flush=True)
+    else:
+        client.admin.command("ping")
+    init_openai()
+    get_twilio_client()
+    get_calendar_discovery_doc()
+    print(f"########### Worker warmed up in {time.monotonic() - started:.2f}s", flush=True)
+
+def run_worker(index=0, mode=WORKER_MODE):
+    worker_class = Worker
+    if mode == "warm":
+        warm_up()
+        worker_class = WarmWorker
+
+    # queues are listed by priority, a job is only taken from a queue when all queues before it are empty
+    worker = worker_class(queues=QUEUE_NAMES + [LEGACY_QUEUE_NAME], connection=make_worker_connection(), name=worker_name(index, os.getpid()), serializer=CompactSerializer)
+    try:
+        # the scheduler runs delayed jobs such as the periodic analytics flush
+        worker.work(with_scheduler=True)
+    finally:
+        print(f"########### Worker {worker.name} stopped: {worker.successful_job_count} succeeded, {worker.failed_job_count} failed", flush=True)
+        # write out buffered analytics before the worker goes away
+        flush_interactions()
+
+def report_job_counts(children):
+    for index, process in sorted(children.items()):
+        worker = Worker.find_by_key(Worker.redis_worker_namespace_prefix + worker_name(index, process.pid), connection=r_worker)
+        if worker:
+            print(f"########### Worker {index} (pid {process.pid}): {worker.successful_job_count} succeeded, {worker.failed_job_count} failed, state: {worker.get_state()}", flush=True)
+        else:
+            print(f"########### Worker {index} (pid {process.pid}): not registered yet", flush=True)
+
+def supervise(concurrency, mode=WORKER_MODE):
+    """
+    Run `concurrency` worker processes, restart the ones that crash and drain all of them on SIGTERM.
+    """
+    # spawn gives every child its own mongo and redis connections instead of sharing forked sockets
+    context = multiprocessing.get_context("spawn")
+    children = {}
+    started_at = {}
+    restarts = {index: 0 for index in range(concurrency)}
+    stopping = False
+
+    def start_child(index):
+        process = context.Process(target=run_worker, args=(index, mode), name=f"kalenda-worker-{index}")
+        process.start()
+        children[index] = process
+        started_at[index] = time.monotonic()
+        print(f"########### Started worker {index} (pid {process.pid})", flush=True)
+
+    def stop_children(signum, frame):
+        nonlocal stopping
+        stopping = True
+        print(f"########### Received signal {signum}, draining {len(children)} workers", flush=True)
+        for process in children.values():
+            if process.is_alive():
+                # RQ treats SIGTERM as a warm shutdown: the current job finishes first
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+
+    for index in range(concurrency):
+        start_child(index)
+
+    last_report = time.monotonic()
+    while not stopping:
+        time.sleep(1)
+        for index, process in list(children.items()):
+            if process.is_alive() or stopping:
+                continue
+            # a child that ran for a while crashed once, one that dies right away is crash looping
+            restarts[index] = 1 if time.monotonic() - started_at[index] > RESTART_BACKOFF_MAX else restarts[index] + 1
+            backoff = min(2 ** restarts[index], RESTART_BACKOFF_MAX)
+            print(f"########### Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting in {backoff}s", flush=True)
+            time.sleep(backoff)
+            if not stopping:
+                start_child(index)
+
+        if time.monotonic() - last_report >= WORKER_REPORT_INTERVAL:
+            report_job_counts(children)
+            last_report = time.monotonic()
+
+    deadline = time.monotonic() + WORKER_SHUTDOWN_GRACE
+    for index, process in children.items():
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            print(f"########### Worker {index} (pid {process.pid}) did not stop in time, killing it", flush=True)
+            process.kill()
+            process.join()
+    print("########### All workers stopped", flush=True)
 
 if __name__ == "__main__":
-    worker = Worker(queues=["kalenda"], connection=r_worker)
-    worker.work()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run Kalenda RQ workers.")
+    parser.add_argument("-n", "--workers", type=int, default=WORKER_CONCURRENCY, help="number of worker processes (default: WORKER_CONCURRENCY or 1)")
+    parser.add_argument("--mode", choices=["fork", "warm"], default=WORKER_MODE, help="fork a process per job, or run jobs in a warm long-lived process (default: WORKER_MODE or fork)")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        supervise(args.workers, args.mode)
+    else:
+        run_worker(mode=args.mode)